@@ -0,0 +1 @@
+# Benchmarks of the Otter hot paths against local stand-ins of an ESX host, see python -m bench --help
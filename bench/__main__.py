@@ -0,0 +1,72 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+from bench.benchmarks import BENCHMARKS, run
+
+# Revision of the tree being measured, so that results of different releases can be compared
+def revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark Otter hot paths against local stand-ins of the VNC console, the serial port and vSphere")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark", help=f"benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+    parser.add_argument("-o", "--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--iterations", type=int, help="measurements per benchmark")
+    parser.add_argument("--frames", help="folder of PNG screenshots to use as prerecorded framebuffers")
+    parser.add_argument("--serial-log", help="captured serial log to replay, a synthetic boot log otherwise")
+    parser.add_argument("--baudrate", type=int, help="replay speed of the serial line for wait_serial")
+    parser.add_argument("--log-size", type=int, help="bytes of serial log replayed by read_serial_memory")
+    parser.add_argument("--machines", help="comma separated inventory sizes for inventory")
+    parser.add_argument("--latency", type=float, help="seconds per fake vSphere round trip")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark {', '.join(unknown)}, choose from {', '.join(BENCHMARKS)}")
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    options = {
+        "iterations": args.iterations,
+        "frames": args.frames,
+        "serial_log": args.serial_log,
+        "baudrate": args.baudrate,
+        "log_size": args.log_size,
+        "sizes": tuple(int(size) for size in args.machines.split(",")) if args.machines else None,
+        "latency": args.latency,
+    }
+    options = {name: value for name, value in options.items() if value is not None}
+
+    # wait_screen prints the text it reads, keep stdout for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args.benchmarks, **options)
+    report = {
+        "meta": {
+            "revision": revision(),
+            "date": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "options": options,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import logging
+import resource
+import statistics
+import threading
+import tracemalloc
+from tempfile import TemporaryDirectory
+from time import sleep, time
+
+import numpy as np
+
+from otter import Otter
+from otter.ocr import available_backends, get_backend
+from bench.fakevnc import FakeVNCServer, load_frames, text_frame
+from bench.fakeserial import FakeSerialPort, load_serial_log
+from bench.fakevsphere import FakeAdapter
+
+# Stands in for a vmware.Machine in an Otter session: the consoles are a FakeVNCServer and a
+# FakeSerialPort, power and snapshot operations do nothing
+class StandInMachine:
+    def __init__(self, vnc_server, serial_port, name="otter-bench"):
+        self.vnc_server = vnc_server
+        self.serial_port = serial_port
+        self.name = name
+        self.moid = "vm-bench"
+
+    def revertSnapshot(self, name):
+        return True
+
+    def getPowerState(self):
+        return True
+
+    def powerOn(self):
+        return True
+
+    def powerOff(self):
+        return True
+
+    def getSerialPort(self, localvm=None):
+        return self.serial_port.device
+
+    def getVNC(self, port=None, local=True):
+        return (self.vnc_server.host, self.vnc_server.port)
+
+    def killVNC(self, ports=[]):
+        pass
+
+
+# An Otter session on stand-in consoles, closed (with its stand-ins) by close()
+class Session:
+    def __init__(self, baudrate=115200, size=(1024, 768), serial_tail_size=1024*1024, ocr_backend="auto"):
+        self.folder = TemporaryDirectory()
+        self.vnc_server = FakeVNCServer(*size)
+        self.serial_port = FakeSerialPort(baudrate)
+        self.machine = StandInMachine(self.vnc_server, self.serial_port)
+        self.otter = Otter(self.machine, None, "bench", outputfolder=self.folder.name, ocr_socket=None, serial_tail_size=serial_tail_size, ocr_backend=ocr_backend)
+
+    def close(self):
+        self.otter.exit()
+        self.serial_port.close()
+        self.vnc_server.close()
+        self.folder.cleanup()
+
+
+# Milliseconds statistics of a list of durations in seconds
+def summary(durations):
+    durations = sorted(durations)
+    if not durations:
+        return {"count": 0}
+    return {
+        "count": len(durations),
+        "min_ms": durations[0] * 1000,
+        "median_ms": statistics.median(durations) * 1000,
+        "mean_ms": statistics.fmean(durations) * 1000,
+        "p95_ms": durations[min(int(len(durations) * 0.95), len(durations) - 1)] * 1000,
+        "max_ms": durations[-1] * 1000,
+    }
+
+# Time from a framebuffer change on the server to the return of the wait started before it.
+# wait runs in a thread and returns True when it saw the change, change makes it and returns
+# the version number of the change.
+def _wait_latency(server, wait, change, iterations):
+    latencies = []
+    failures = 0
+    for index in range(iterations):
+        done = {}
+        thread = threading.Thread(target=lambda: done.update(result=wait(index), end=time()))
+        thread.start()
+        # let the wait do its first poll on the old screen
+        sleep(0.2)
+        version = change(index)
+        thread.join()
+        if done.get("result"):
+            latencies.append(done["end"] - server.changed_at[version])
+        else:
+            failures += 1
+    return dict(summary(latencies), failures=failures)
+
+
+# wait_image on random patterns shown at random positions, template matching without OCR
+def bench_wait_image(iterations=20, size=(1024, 768), patch=(64, 32), **options):
+    session = Session(size=size)
+    random = np.random.default_rng(0)
+    patches = [random.integers(0, 256, (patch[1], patch[0], 3), dtype=np.uint8) for _ in range(iterations)]
+
+    def change(index):
+        frame = session.vnc_server.frame.copy()
+        x = int(random.integers(0, size[0] - patch[0]))
+        y = int(random.integers(0, size[1] - patch[1]))
+        frame[y:y + patch[1], x:x + patch[0]] = patches[index]
+        return session.vnc_server.show(frame)
+
+    try:
+        result = _wait_latency(session.vnc_server, lambda index: session.otter.wait_image(patches[index], timeout=30),
+                               change, iterations)
+    finally:
+        session.close()
+    return dict(result, screen=list(size), patch=list(patch))
+
+
+# wait_screen on a line of text appearing in a window, OCR included, with every OCR backend installed
+def bench_wait_screen(iterations=5, size=(1024, 768), **options):
+    backends = available_backends()
+    if not backends:
+        return {"skipped": "no OCR backend is installed"}
+    region = (80, 80, 440, 100)
+    results = {}
+    for backend in backends:
+        session = Session(size=size, ocr_backend=backend)
+        try:
+            # load the models before measuring
+            session.otter.get_screen_text(session.otter.capture_screen_array(region))
+            results[backend] = _wait_latency(session.vnc_server,
+                                             lambda index: session.otter.wait_screen(f"phase {index}", region, timeout=120),
+                                             lambda index: session.vnc_server.show(text_frame(f"Qubes OS phase {index}", size)),
+                                             iterations)
+        finally:
+            session.close()
+    return {"backends": results, "screen": list(size), "region": list(region)}
+
+
+# OCR regions per second for growing region sizes of the prerecorded frames, with and without textline,
+# for every OCR backend installed
+def bench_ocr_throughput(iterations=5, frames=None, regions=((200, 40), (400, 100), (800, 300), (1024, 768)), **options):
+    backends = available_backends()
+    if not backends:
+        return {"skipped": "no OCR backend is installed"}
+    images = [np.asarray(frame) for frame in load_frames(frames)]
+    results = []
+    for name in backends:
+        backend = get_backend(name)
+        # warm up
+        backend.read(images[0][:40, :200])
+        for width, height in regions:
+            for textline in (False, True):
+                durations = []
+                for index in range(iterations):
+                    region = images[index % len(images)][80:80 + height, 80:80 + width]
+                    started = time()
+                    backend.read(region, textline)
+                    durations.append(time() - started)
+                results.append(dict(summary(durations), backend=name, width=width, height=height, textline=textline,
+                                    regions_per_second=len(durations) / sum(durations)))
+    return {"regions": results}
+
+
+# Time from the last byte of a marker written on the serial line to the return of wait_serial,
+# with background output replayed from the serial log in between
+def bench_wait_serial(iterations=20, baudrate=115200, serial_log=None, **options):
+    session = Session(baudrate)
+    noise = load_serial_log(serial_log, 4096)[:4096]
+    latencies = []
+    failures = 0
+    try:
+        for index in range(iterations):
+            marker = f"otter-bench-marker-{index}\r\n".encode("utf-8")
+            done = {}
+            thread = threading.Thread(target=lambda: done.update(result=session.otter.wait_serial(marker.decode("utf-8"), timeout=30), end=time()))
+            thread.start()
+            written = session.serial_port.write(noise + marker)
+            thread.join()
+            if done.get("result"):
+                latencies.append(done["end"] - written)
+            else:
+                failures += 1
+    finally:
+        session.close()
+    return dict(summary(latencies), failures=failures, baudrate=baudrate)
+
+
+# Memory of a session while a long serial log is replayed as fast as possible and consumed with
+# read_serial: it should stay around serial_tail_size whatever the log size
+def bench_read_serial_memory(log_size=64*1024*1024, serial_tail_size=1024*1024, serial_log=None, **options):
+    data = load_serial_log(serial_log, log_size)
+    tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    session = Session(0, serial_tail_size=serial_tail_size)
+    samples = []
+    try:
+        started = time()
+        replay = session.serial_port.replay(data, 65536)
+        consumed = 0
+        while replay.is_alive() or session.otter.serial_offset < len(data):
+            consumed += len(session.otter.read_serial(0.05))
+            samples.append(tracemalloc.get_traced_memory()[0])
+            if time() - started > 600:
+                break
+        elapsed = time() - started
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        session.close()
+        tracemalloc.stop()
+    return {
+        "log_bytes": len(data),
+        "consumed_bytes": consumed,
+        "serial_tail_size": serial_tail_size,
+        "seconds": elapsed,
+        "megabytes_per_second": len(data) / elapsed / 1024**2,
+        "traced_current_bytes": current,
+        "traced_peak_bytes": peak,
+        "traced_median_bytes": statistics.median(samples) if samples else 0,
+        # KiB on Linux, the high water mark of the process so only growth is meaningful
+        "max_rss_growth_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+    }
+
+
+# listMachines and the lookups against fake inventories of growing size, latency seconds per round trip
+def bench_inventory(sizes=(100, 1000, 5000), latency=0.02, iterations=20, **options):
+    results = []
+    for size in sizes:
+        adapter = FakeAdapter(size, latency)
+        started = time()
+        adapter.listMachines()
+        cold = time() - started
+        cold_calls = adapter.connection.calls
+        timings = {"listMachines": [], "getFreeMachine": [], "getMachineByName": [], "getMachineByMAC": []}
+        for index in range(iterations):
+            target = (index * 7919) % size
+            for name, call in (("listMachines", lambda: adapter.listMachines()),
+                               ("getFreeMachine", lambda: adapter.getFreeMachine("otter-test")),
+                               ("getMachineByName", lambda: adapter.getMachineByName(f"otter-test-{target:05d}")),
+                               ("getMachineByMAC", lambda: adapter.getMachineByMAC(f"00:50:56:{target >> 16 & 0xff:02x}:{target >> 8 & 0xff:02x}:{target & 0xff:02x}"))):
+                started = time()
+                call()
+                timings[name].append(time() - started)
+        results.append({
+            "machines": size,
+            "cold_refresh": dict(summary([cold]), round_trips=cold_calls),
+            "warm": {name: summary(durations) for name, durations in timings.items()},
+            "round_trips": adapter.connection.calls,
+        })
+    return {"latency_s": latency, "inventories": results}
+
+
+BENCHMARKS = {
+    "wait_image": bench_wait_image,
+    "wait_screen": bench_wait_screen,
+    "ocr_throughput": bench_ocr_throughput,
+    "wait_serial": bench_wait_serial,
+    "read_serial_memory": bench_read_serial_memory,
+    "inventory": bench_inventory,
+}
+
+def run(names=None, **options):
+    results = {}
+    for name in names or BENCHMARKS:
+        logging.info(f"Running benchmark {name}")
+        started = time()
+        try:
+            results[name] = BENCHMARKS[name](**options)
+        except Exception as e:
+            logging.exception(f"Benchmark {name} failed")
+            results[name] = {"error": repr(e)}
+        results[name]["wall_seconds"] = time() - started
+    return results
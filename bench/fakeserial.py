@@ -0,0 +1,77 @@
+import os
+import threading
+import tty
+from time import sleep, time
+
+# A pty pair standing in for the serial pipe of a machine: Otter opens the slave device like it
+# opens /dev/ttySx, the replay writes on the master side at the speed of a real serial line
+# (10 bits per byte at baudrate, 0 for as fast as possible).
+class FakeSerialPort:
+    def __init__(self, baudrate=115200):
+        self.baudrate = baudrate
+        self.master, slave = os.openpty()
+        # no echo and no line discipline, like a serial line
+        tty.setraw(slave)
+        self.device = os.ttyname(slave)
+        # keep the slave open, otherwise writes on the master fail until Otter opens it
+        self.slave = slave
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+
+    # Write data at the line speed, blocking. Returns the time the last byte was written.
+    def write(self, data, chunk_size=64):
+        bytes_per_second = self.baudrate / 10 if self.baudrate else 0
+        written_at = time()
+        with self.lock:
+            for start in range(0, len(data), chunk_size):
+                if self.stopped:
+                    break
+                chunk = data[start:start + chunk_size]
+                started = time()
+                view = memoryview(chunk)
+                while view:
+                    written = os.write(self.master, view)
+                    view = view[written:]
+                written_at = time()
+                if bytes_per_second:
+                    delay = len(chunk) / bytes_per_second - (time() - started)
+                    if delay > 0:
+                        sleep(delay)
+            return written_at
+
+    # Replay data (a captured serial log) in background
+    def replay(self, data, chunk_size=64):
+        self.thread = threading.Thread(target=self.write, args=(data, chunk_size), name="fake-serial-replay", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    # Whatever Otter wrote to the port
+    def read(self, size=65536):
+        return os.read(self.master, size)
+
+    def close(self):
+        self.stopped = True
+        if self.thread:
+            self.thread.join(timeout=5)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+# A captured serial log, or when there is none a synthetic one looking like a Qubes boot of about size bytes
+def load_serial_log(path=None, size=1024*1024):
+    if path:
+        with open(path, "rb") as f:
+            return f.read()
+    lines = []
+    total = 0
+    index = 0
+    while total < size:
+        line = f"[{index * 0.004:12.6f}] xen: domain {index % 7} event channel {index} bound, qubesdb watch /qubes-vm-{index % 13}\r\n"
+        lines.append(line.encode("utf-8"))
+        total += len(line)
+        index += 1
+    return b"".join(lines)
@@ -0,0 +1,197 @@
+import glob
+import os
+import socket
+import struct
+import threading
+from time import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# A scripted RFB 3.8 server (no authentication, raw encoding) serving a framebuffer kept in memory.
+# Frames are played with show(): only the bounding box of what changed since the previous frame is
+# sent as an incremental update, like a real server would. Incremental update requests are answered
+# as soon as the framebuffer changes, each client has a reader thread handling its messages and a
+# sender thread pushing the updates, so key and pointer events are never held up by a pending update.
+class FakeVNCServer:
+    def __init__(self, width=1024, height=768, host="127.0.0.1", port=0):
+        self.width = width
+        self.height = height
+        self.frame = np.zeros((height, width, 3), np.uint8)
+        self.condition = threading.Condition()
+        self.version = 0
+        # (version, rectangle) of the recent changes, oldest first
+        self.changes = []
+        # time every change was made, to measure the latency of the waits
+        self.changed_at = {}
+        # (down, keysym, time) of the key events received
+        self.keys = []
+        self.running = True
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen()
+        self.host, self.port = self.socket.getsockname()[:2]
+        threading.Thread(target=self._serve, name="fake-vnc", daemon=True).start()
+
+    # Show image (PIL image or RGB numpy array), returns the version number of the change or None if identical
+    def show(self, image):
+        frame = np.asarray(image.convert("RGB") if isinstance(image, Image.Image) else image, np.uint8)
+        with self.condition:
+            changed = np.any(frame != self.frame, axis=2)
+            if not changed.any():
+                return None
+            rows = np.flatnonzero(changed.any(axis=1))
+            columns = np.flatnonzero(changed.any(axis=0))
+            x, y = int(columns[0]), int(rows[0])
+            rectangle = (x, y, int(columns[-1]) - x + 1, int(rows[-1]) - y + 1)
+            self.frame = frame.copy()
+            return self._changed(rectangle)
+
+    # Fill a rectangle with a solid color, returns the version number of the change
+    def fill(self, x, y, width, height, color):
+        with self.condition:
+            self.frame[y:y + height, x:x + width] = color
+            return self._changed((x, y, width, height))
+
+    def _changed(self, rectangle):
+        self.version += 1
+        self.changes.append((self.version, rectangle))
+        del self.changes[:-64]
+        self.changed_at[self.version] = time()
+        self.condition.notify_all()
+        return self.version
+
+    def close(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        self.socket.close()
+
+    def _serve(self):
+        while self.running:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._client, args=(client,), name="fake-vnc-client", daemon=True).start()
+
+    def _recv(self, client, size):
+        data = b""
+        while len(data) < size:
+            chunk = client.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _encode(self, rectangles, shifts):
+        message = struct.pack("!BxH", 0, len(rectangles))
+        for x, y, width, height in rectangles:
+            pixels = self.frame[y:y + height, x:x + width]
+            # 32 bits little endian true color, every channel in the byte of its shift
+            raw = np.zeros((height, width, 4), np.uint8)
+            for channel, shift in enumerate(shifts):
+                raw[..., shift // 8] = pixels[..., channel]
+            message += struct.pack("!HHHHi", x, y, width, height, 0) + raw.tobytes()
+        return message
+
+    def _client(self, client):
+        # red, green and blue shifts, BGRX unless the client asks otherwise
+        state = {"shifts": (16, 8, 0), "pending": False, "seen": self.version, "open": True}
+        send_lock = threading.Lock()
+
+        def send_full():
+            with self.condition:
+                state["seen"] = self.version
+                message = self._encode([(0, 0, self.width, self.height)], state["shifts"])
+            with send_lock:
+                client.sendall(message)
+
+        def sender():
+            try:
+                while True:
+                    with self.condition:
+                        self.condition.wait_for(lambda: not self.running or not state["open"] or (state["pending"] and self.version != state["seen"]))
+                        if not self.running or not state["open"]:
+                            return
+                        rectangles = [rectangle for version, rectangle in self.changes if version > state["seen"]]
+                        if not self.changes or self.changes[0][0] > state["seen"] + 1:
+                            # older changes have been forgotten
+                            rectangles = [(0, 0, self.width, self.height)]
+                        state["seen"] = self.version
+                        state["pending"] = False
+                        message = self._encode(rectangles, state["shifts"])
+                    with send_lock:
+                        client.sendall(message)
+            except OSError:
+                pass
+
+        try:
+            client.sendall(b"RFB 003.008\n")
+            self._recv(client, 12)
+            client.sendall(b"\x01\x01")
+            self._recv(client, 1)
+            client.sendall(struct.pack("!I", 0))
+            # shared flag
+            self._recv(client, 1)
+            pixel_format = struct.pack("!BBBBHHHBBBxxx", 32, 24, 0, 1, 255, 255, 255, *state["shifts"])
+            client.sendall(struct.pack("!HH", self.width, self.height) + pixel_format + struct.pack("!I", 4) + b"fake")
+            threading.Thread(target=sender, name="fake-vnc-sender", daemon=True).start()
+            while self.running:
+                message_type = self._recv(client, 1)[0]
+                if message_type == 0:
+                    pixel_format = self._recv(client, 19)
+                    state["shifts"] = struct.unpack("!BBB", pixel_format[13:16])
+                elif message_type == 2:
+                    count = struct.unpack("!xH", self._recv(client, 3))[0]
+                    self._recv(client, 4 * count)
+                elif message_type == 3:
+                    incremental = struct.unpack("!BHHHH", self._recv(client, 9))[0]
+                    if incremental:
+                        with self.condition:
+                            state["pending"] = True
+                            self.condition.notify_all()
+                    else:
+                        send_full()
+                elif message_type == 4:
+                    down, key = struct.unpack("!BxxI", self._recv(client, 7))
+                    self.keys.append((down, key, time()))
+                elif message_type == 5:
+                    self._recv(client, 5)
+                elif message_type == 6:
+                    length = struct.unpack("!xxxI", self._recv(client, 7))[0]
+                    self._recv(client, length)
+                else:
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.condition:
+                state["open"] = False
+                self.condition.notify_all()
+            client.close()
+
+
+# Prerecorded framebuffers: the PNG files of folder in name order (for instance the screenshots of an
+# Otter run), or when there are none, generated desktop-like frames with a line of text each
+def load_frames(folder=None, size=(1024, 768), count=20):
+    if folder:
+        paths = sorted(glob.glob(os.path.join(folder, "*.png")), key=lambda path: (len(path), path))
+        if paths:
+            return [Image.open(path).convert("RGB").resize(size) for path in paths]
+    return [text_frame(f"Qubes OS step {index} of {count}", size) for index in range(count)]
+
+# A grey desktop with a window showing text at (x, y)
+def text_frame(text, size=(1024, 768), x=100, y=100):
+    image = Image.new("RGB", size, (60, 60, 60))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((x - 20, y - 20, x + 400, y + 60), fill=(240, 240, 240))
+    try:
+        font = ImageFont.load_default(size=28)
+    except TypeError:
+        # Pillow < 10.1, small bitmap font only
+        font = ImageFont.load_default()
+    draw.text((x, y), text, fill=(0, 0, 0), font=font)
+    return image
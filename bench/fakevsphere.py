@@ -0,0 +1,93 @@
+from time import sleep
+
+from pyVmomi import vim, vmodl
+
+from vmware import MachineRegistry, vmwareAdapter
+
+# An in-process stand-in for the few vSphere calls the inventory goes through: RetrieveContent,
+# CreateContainerView and paged RetrievePropertiesEx. Every call costs latency seconds, like a round
+# trip to a real host, and every object returned object_cost seconds more. calls counts the round trips.
+class FakeConnection:
+    def __init__(self, machines=1000, latency=0.02, object_cost=0.00002, page_size=100, powered_on=0.5):
+        self.latency = latency
+        self.object_cost = object_cost
+        self.page_size = page_size
+        self.calls = 0
+        self.objects = [self._machine(index, index < machines * powered_on) for index in range(machines)]
+        self.content = self
+
+    def _machine(self, index, powered_on):
+        config = vim.vm.Summary.ConfigSummary(
+            name=f"otter-test-{index:05d}", template=False,
+            vmPathName=f"[datastore1] otter-test-{index:05d}/otter-test-{index:05d}.vmx",
+            guestFullName="Other 5.x or later Linux (64-bit)", instanceUuid=f"5000{index:028x}", annotation="")
+        devices = vim.vm.device.VirtualDevice.Array([
+            vim.vm.device.VirtualVmxnet3(key=4000, macAddress=f"00:50:56:{index >> 16 & 0xff:02x}:{index >> 8 & 0xff:02x}:{index & 0xff:02x}"),
+            vim.vm.device.VirtualSerialPort(key=9000, backing=vim.vm.device.VirtualSerialPort.PipeBackingInfo(pipeName=f"otter-pipe-{index}", endpoint="server")),
+        ])
+        power_state = vim.VirtualMachinePowerState.poweredOn if powered_on else vim.VirtualMachinePowerState.poweredOff
+        properties = {
+            "summary.config": config,
+            "summary.runtime.powerState": power_state,
+            "config.hardware.device": devices,
+        }
+        return vmodl.query.PropertyCollector.ObjectContent(
+            obj=vim.VirtualMachine(f"vm-{index + 1}"),
+            propSet=[vmodl.DynamicProperty(name=name, val=value) for name, value in properties.items()])
+
+    def _call(self, objects=0):
+        self.calls += 1
+        sleep(self.latency + objects * self.object_cost)
+
+    def RetrieveContent(self):
+        self._call()
+        return self
+
+    @property
+    def rootFolder(self):
+        return None
+
+    @property
+    def viewManager(self):
+        return self
+
+    @property
+    def propertyCollector(self):
+        return self
+
+    def CreateContainerView(self, container, types, recursive):
+        self._call()
+        view = FakeView("session[fake]view")
+        view.connection = self
+        return view
+
+    def _page(self, start):
+        objects = self.objects[start:start + self.page_size]
+        self._call(len(objects))
+        token = None
+        if start + self.page_size < len(self.objects):
+            token = str(start + self.page_size)
+        return vmodl.query.PropertyCollector.RetrieveResult(objects=objects, token=token)
+
+    def RetrievePropertiesEx(self, specs, options):
+        return self._page(0)
+
+    def ContinueRetrievePropertiesEx(self, token):
+        return self._page(int(token))
+
+
+# the view goes into a real FilterSpec, which only takes managed objects
+class FakeView(vim.view.ContainerView):
+    def Destroy(self):
+        self.connection._call()
+
+
+# vmwareAdapter on top of a FakeConnection, only the inventory calls are backed
+class FakeAdapter(vmwareAdapter):
+    def __init__(self, machines=1000, latency=0.02, **options):
+        self.connection = FakeConnection(machines, latency, **options)
+        self.host = "fake-esx.local"
+        self.verify = False
+        self.vmname = ""
+        self.registry = MachineRegistry(self)
+        self.tasks = None
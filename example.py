@@ -1,5 +1,6 @@
 from configparser import ConfigParser
 import vmware
+from vmware.pool import MachinePool
 import logging
 from otter import Otter
 from helpers import qubes
@@ -16,8 +17,9 @@ vms = config.get('esx', 'vms')
 
 adapter = vmware.vmwareAdapter(username, password, host, headers={}, verify=False)
 
-# Look for a free machine with "Qubes 42 Otter" name prefix
-vm = adapter.getFreeMachine(vms)
+# Lease a free machine with "Qubes 42 Otter" name prefix, so that parallel runs never share it
+pool = MachinePool(adapter, vms)
+vm = pool.acquire()[0]
 # Initialize otter, will spawn VNC + serial
 otter = Otter(vm, adapter, testfile=None, screenrecord=None)
 # Serial console login example, with success checking
@@ -30,3 +32,5 @@ qubes.run_command_in_qube_serial_and_wait(otter, "sys-net", "id", "groups")
 qubes.launch_terminal_dom0(otter)
 # Save logs and poweroff
 otter.exit()
+# Give the machine back to the pool
+pool.release(vm)
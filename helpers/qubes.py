@@ -1,10 +1,21 @@
 import logging
-from time import sleep
+import re
+
+from otter import metrics
 
 # gui operations calculated on screen 1280*1024
 # for installations it's always 800x600 unless bot parameters are changed
 
+# serial output after which a step can not succeed anymore, waits end early on any of these
+SERIAL_FAILURES = [
+    re.compile(r"Kernel panic - [^\r\n]*"),
+    "Login incorrect",
+    re.compile(r"qvm-run: error: [^\r\n]*"),
+]
+
+@metrics.timed("qubes.login_serial")
 def login_serial(otter, username="user", password="password"):
+    start = otter.serial_offset
     # wair for dom0 serial login
     logging.info("Waiting for the serial login prompt")
     otter.wait_serial("dom0 login: ")
@@ -12,14 +23,17 @@ def login_serial(otter, username="user", password="password"):
     logging.info("Typing serial username")
     otter.write_serial(f"{username}\n")
     logging.info("Typing serial password")
-    otter.write_serial(f"{password}\n")
+    otter.wait_serial("Password: ", timeout=30)
+    # not echoed
+    otter.write_serial(f"{password}\n", echo=False)
     logging.info("Reading serial login result")
-    otter.read_serial()
+    result = otter.expect_serial([f"{username}@dom0"] + SERIAL_FAILURES, timeout=60)
 
-    logging.info(otter.serial_output.decode("utf-8"))
+    logging.info(otter.serial_log(start).decode("utf-8", errors="replace"))
 
-    assert(f"{username}@dom0" in otter.serial_output.decode('utf-8'))
+    assert(result and result.index == 0)
 
+@metrics.timed("qubes.login_gui")
 def login_gui(otter, username="user", password="password"):
     # we expect 800x600 screen at login
     logging.info("Waiting for Qubes login screen")
@@ -27,29 +41,33 @@ def login_gui(otter, username="user", password="password"):
     # we do not support switching from the selected username for now, we can do it if needed
     # sends credentials
     logging.info("Typing password and logging in")
-    for char in password:
-        otter.vnc_client.keyPress(char)
-    otter.vnc_client.keyPress("enter")
+    otter.type_text(f"{password}\n")
 
     logging.info("Waiting for the desktop")
-    sleep(5)
-
-    assert(otter.wait_screen("user", (1200, 0, 80, 30)))
+    # the top bar user label is a single line of text, no need for text detection
+    assert(otter.wait_screen("user", (1200, 0, 80, 30), textline=True))
 
+@metrics.timed("qubes.launch_terminal_dom0")
 def launch_terminal_dom0(otter):
     logging.info("Starting xfce4-terminal in dom0")
-    otter.write_serial("export DISPLAY=:0\n")
-    otter.write_serial("xfce4-terminal\n")
-    sleep(3)
-    otter.read_serial()
+    otter.write_serial("export DISPLAY=:0\nxfce4-terminal\n")
+    found = otter.wait_screen("Terminal", (0, 30, 300, 100))
+    output = otter.read_serial(0)
 
-    logging.info(otter.serial_output.decode("utf-8"))
-    assert(otter.wait_screen("Terminal", (0, 30, 300, 100)))
+    logging.info(output.decode("utf-8", errors="replace"))
+    assert(found)
 
+@metrics.timed("qubes.run_command_in_qube_serial_and_wait")
 def run_command_in_qube_serial_and_wait(otter, qube, command, string):
+    result = run_command_in_qube_serial_and_expect(otter, qube, command, [string] + SERIAL_FAILURES)
+    assert(result and result.index == 0)
+
+# Returns the ExpectMatch of whichever pattern shows up first, or None on timeout
+@metrics.timed("qubes.run_command_in_qube_serial_and_expect")
+def run_command_in_qube_serial_and_expect(otter, qube, command, patterns, timeout=360):
     cmd = f"qvm-run --pass-io '{qube}' '{command}'\n"
     otter.write_serial(cmd)
-    assert(otter.wait_serial(string))
+    return otter.expect_serial(patterns, timeout)
 
 def run_command_in_qube_screen_and_wait(otter, command, waitstring, coordinates=()):
     # we could hack this and open the terminal via serial
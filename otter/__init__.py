@@ -1,23 +1,58 @@
 from tempfile import TemporaryDirectory
+from collections import OrderedDict
 from PIL import Image
-from vncdotool import api
+import numpy as np
 import logging
 import serial
 import socket
+import hashlib
+import threading
 import os
-import easyocr
+
+from otter.ocr import get_backend, get_reader
+from otter.match import match_template, to_grey
+from otter.serialreader import SerialReader
+from otter.expect import Expect
+from otter.vnc import call_protocol, connect as connect_vnc
+from otter.ocrd import OCRClient, DEFAULT_SOCKET
+from otter.recorder import ScreenRecorder
+from otter import metrics
 
 from time import sleep, time
 
+# characters typed with a named key
+TEXT_KEYS = {"\n": "enter", "\t": "tab"}
+
 class Otter:
-    def __init__(self, machine, adapter, testfile, outputfolder="", screenrecord=False, start_snapshot="kickstart", baudrate=115200):
+    def __init__(self, machine, adapter, testfile, outputfolder="", screenrecord=False, start_snapshot="kickstart", baudrate=115200, screenshot_every=0, ocr_cache_size=64, ocr_socket=DEFAULT_SOCKET, serial_tail_size=1024*1024, metrics_enabled=False, ocr_backend="auto", ocr_options=None):
         self.machine = machine
         self.adapter = adapter
         self.testfile = testfile
         self.outputfolder = outputfolder
 
-        self.serial_output = b""
+        self.serial_reader = None
+        # offset in the serial stream up to which output has already been consumed
+        self.serial_cursor = 0
+        # write_serial waits for the echo of every line, until a guest is found not to echo
+        self.serial_echo = True
         self.screen_count = 0
+        # OCR polls read the framebuffer from memory, only every Nth one is saved to disk (0 = never)
+        self.screenshot_every = screenshot_every
+        self.poll_count = 0
+        # bounded LRU of OCR results keyed by the region content fingerprint
+        self.ocr_cache = OrderedDict()
+        self.ocr_cache_size = ocr_cache_size
+        # use the shared OCR daemon if it is running, otherwise fall back to the in-process reader
+        self.ocr_client = OCRClient(ocr_socket) if ocr_socket else None
+        # in-process OCR engine, loaded on first use (see otter.ocr.get_backend)
+        self.ocr_backend = ocr_backend
+        self.ocr_options = ocr_options or {}
+        self._ocr = None
+        if metrics_enabled:
+            metrics.enable()
+        # the session trace holds the spans of this thread since now
+        self.started = time()
+        self.thread = threading.get_ident()
 
         if len(outputfolder) == 0:
             # generate dir in tmp
@@ -34,40 +69,58 @@ class Otter:
 
         logging.info(f"Starting Otter, outdir: {outputfolder}, vm: {self.machine.name}")
 
-        # restore snapshot
-        logging.info(f"Reverting to snapshot {start_snapshot}")
-        self.machine.revertSnapshot(start_snapshot)
+        # restore snapshot, unless the machine was prepared already (see MachinePool.acquire)
+        if start_snapshot:
+            logging.info(f"Reverting to snapshot {start_snapshot}")
+            with metrics.span("otter.init.revert"):
+                self.machine.revertSnapshot(start_snapshot)
 
         # power on machine and get the consoles
-        logging.info(f"Powering on machine {self.machine.name} id: {self.machine.moid}")
-        machine.powerOn()
+        with metrics.span("otter.init.power_on"):
+            self._power_on()
 
         # get machine connection details
-        self.serial = machine.getSerialPort()
-
-        try:
-            self.serial_obj = serial.Serial(self.serial, baudrate)
-        except Exception as e:
-            logging.error("Failed to open serial port")
-            self.machine.powerOff()
-        
-        self.vnc = machine.getVNC()
+        with metrics.span("otter.init.serial_port"):
+            self.serial = machine.getSerialPort()
+        self.baudrate = baudrate
+        self.serial_tail_size = serial_tail_size
 
+        self.vnc_client = None
+        # framebuffer updates reported by the server, None if not connected
+        self.damage = None
+        self.recorder = None
         if screenrecord:
-            # get extra VNC socket just for the recorder
-            self.screenrecord_vnc = machine.getVNC()
-            # and pick a library/method for recording
-            # TODO
-            pass
+            # the recorder samples the framebuffer the session already keeps current,
+            # no extra VNC connection is needed
+            self.recorder = ScreenRecorder(f"{outputfolder}/screen.mkv")
+            if not self.recorder.start():
+                self.recorder = None
+        with metrics.span("otter.init.attach_vnc"):
+            self._attach_vnc()
+        with metrics.span("otter.init.attach_serial"):
+            self._attach_serial()
+        metrics.record("otter.init", self.started, time() - self.started)
 
-        # TODO: find a better way not to race websocat startup
-        # for instance, we can't test like this or we will use the single use VNC ticket!
-        #while socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect_ex(self.vnc):
-        #    print("Waiting")
+    # A snapshot taken with memory resumes powered on, booting again is not needed
+    def _power_on(self):
+        if self.machine.getPowerState():
+            logging.info(f"Machine {self.machine.name} resumed from a powered on snapshot, skipping power on")
+            return
+        logging.info(f"Powering on machine {self.machine.name} id: {self.machine.moid}")
+        self.machine.powerOn()
+
+    def _attach_vnc(self):
+        # the forwarder is already listening when getVNC returns
+        self.vnc = self.machine.getVNC()
 
         logging.info("Attempting VNC connect")
         try:
-            self.vnc_client = api.connect(server=f"{self.vnc[0]}::{self.vnc[1]}", timeout=5)
+            # the client keeps an incremental update subscription, so the framebuffer is always current
+            # all the sessions of the process share one reactor thread
+            self.vnc_client = connect_vnc(f"{self.vnc[0]}::{self.vnc[1]}", timeout=5)
+            self.damage = self.vnc_client.factory.damage
+            if self.recorder:
+                self.recorder.attach(self.vnc_client)
             # screen is the raw pixel, capture saves the screenshot
             self.vnc_client.refreshScreen(False)
             # test capture
@@ -76,21 +129,86 @@ class Otter:
             logging.error(f"Failed to establish a VNC connection to {self.vnc}")    
             logging.debug(e)    
 
-        self.easyocr = easyocr.Reader(['en'])
+    def _detach_vnc(self):
+        if self.recorder:
+            self.recorder.attach(None)
+        if self.vnc_client:
+            try:
+                self.vnc_client.disconnect()
+            except Exception as e:
+                logging.debug(e)
+        self.vnc_client = None
+        self.damage = None
+        if self.vnc:
+            self.machine.killVNC([self.vnc[1]])
 
+    def _attach_serial(self):
         logging.info(f"Attempting serial connect to {self.serial}")
         try:
-            # would be nice if vmware supports rtscts so we can read non-blocking, let's try
-            self.serial_client = serial.Serial(self.serial, baudrate, timeout=1, rtscts=1)
+            self.serial_client = self._open_serial(self.serial)
             assert(self.serial_client.is_open)
             logging.info(f"Succesfully connected to {self.serial}")
+            if self.serial_reader:
+                # same stream and log, going on from where it was
+                self.serial_reader.attach(self.serial_client)
+            else:
+                # drain the serial port continuously in background
+                # and stream it to disk, keeping only the last serial_tail_size bytes in memory
+                self.serial_reader = SerialReader(self.serial_client, f"{self.outputfolder}/serial.log", self.serial_tail_size)
+                self.serial_reader.start()
         except Exception as e:
             logging.error(f"Failed to connect to serial port {self.serial}")
             logging.debug(e)
 
-        self.reader = easyocr.Reader(['en'])
+    # serial is a local device (/dev/ttySx for pipe ports) or a pyserial URL for network ports
+    def _open_serial(self, url):
+        try:
+            # would be nice if vmware supports rtscts so we can read non-blocking, let's try
+            return serial.serial_for_url(url, self.baudrate, timeout=1, rtscts=1)
+        except serial.SerialException as e:
+            if not url.startswith("rfc2217://"):
+                raise
+            # plain telnet without the COM port option, the port settings are only local anyway
+            logging.warning(f"RFC 2217 negotiation with {url} failed, using a raw socket: {e}")
+            return serial.serial_for_url("socket://" + url[len("rfc2217://"):].split("?")[0], self.baudrate, timeout=1)
 
+    # Save the running machine, memory included, so that later sessions or revert() can start
+    # from this exact point instead of booting (for instance right after login_gui)
+    @metrics.timed("otter.take_snapshot")
+    def take_snapshot(self, name, description=""):
+        logging.info(f"Taking snapshot {name} of {self.machine.name} with memory")
+        return self.machine.takeSnapshot(name, description, withram=True)
 
+    # Revert the machine to a snapshot in the middle of a session, then attach VNC and serial again.
+    # From a snapshot with memory the machine resumes where it was, in seconds.
+    @metrics.timed("otter.revert")
+    def revert(self, snapshot):
+        logging.info(f"Reverting to snapshot {snapshot}")
+        self._detach_vnc()
+        if not self.machine.revertSnapshot(snapshot):
+            logging.error(f"Unable to revert {self.machine.name} to {snapshot}")
+            return False
+        self._power_on()
+        self._attach_vnc()
+        self._attach_serial()
+        # output from before the revert is not waited for anymore
+        self.serial_cursor = self.serial_offset
+        return True
+
+    # The OCR model is loaded lazily on first use and shared across sessions
+    @property
+    def reader(self):
+        return get_reader()
+
+    # The in-process OCR backend, shared by the sessions of the process using the same one.
+    # Resolved once per session, "auto" reads the calibration file.
+    @property
+    def ocr(self):
+        if self._ocr is None:
+            self._ocr = get_backend(self.ocr_backend, **self.ocr_options)
+        return self._ocr
+
+    @metrics.timed("otter.capture_screen")
     def capture_screen_wrapper(self, coordinates=()):
         filename = f"{self.outputfolder}/{self.screen_count}.png"
         try:
@@ -108,60 +226,326 @@ class Otter:
 
         return filename
 
-    def get_screen_text(self, filename):
-        text = self.reader.readtext(filename, detail=0)
-        logging.info(f"Read text '{text}' from {filename}")
+    # Same as capture_screen_wrapper, but nothing touches the disk: the region is cropped
+    # straight from the in-memory framebuffer and returned as a numpy array (None on failure)
+    @metrics.timed("otter.capture_array")
+    def capture_screen_array(self, coordinates=()):
+        try:
+            if self.damage is not None:
+                # no need to ask for a refresh, just crop in the reactor thread
+                screen = call_protocol(self.vnc_client, "cropRegion", *coordinates)
+            else:
+                self.vnc_client.refreshScreen(False)
+                screen = self.vnc_client.screen
+                if len(coordinates) == 4:
+                    x, y, w, h = coordinates
+                    screen = screen.crop((x, y, x + w, y + h))
+            if screen is None:
+                return None
+            return np.asarray(screen.convert("RGB"))
+        except Exception as e:
+            logging.info("In memory capture failed, maybe no updates available")
+            logging.debug(e)
+            return None
+
+    # Persist an already captured array, used for sampling and on failures
+    def save_screen(self, image):
+        filename = f"{self.outputfolder}/{self.screen_count}.png"
+        try:
+            Image.fromarray(image).save(filename)
+            logging.info(f"Screen saved as {filename}")
+            self.screen_count += 1
+        except Exception as e:
+            logging.info(f"Saving {filename} failed")
+            logging.debug(e)
+        return filename
+
+    # Cheap content hash of a captured region, shape included so different crops never collide
+    def fingerprint(self, image):
+        digest = hashlib.blake2b(image.tobytes(), digest_size=16)
+        digest.update(str(image.shape).encode("utf-8"))
+        return digest.digest()
+
+    # image can either be a screenshot full path or a numpy array from capture_screen_array
+    # textline skips text detection for regions known to contain a single line of text
+    def get_screen_text(self, image, textline=False, min_confidence=0):
+        if image is None:
+            return ""
+        if isinstance(image, str):
+            return self._read_screen_text(image, textline, min_confidence)
+        return self._cached_screen_text(image, self.fingerprint(image), textline, min_confidence)
+
+    def _cached_screen_text(self, image, fingerprint, textline=False, min_confidence=0):
+        key = (fingerprint, textline, min_confidence)
+        if key in self.ocr_cache:
+            metrics.count("otter.ocr_cache", result="hit")
+            self.ocr_cache.move_to_end(key)
+            logging.debug("Region content already seen, reusing cached OCR result")
+            return self.ocr_cache[key]
+        metrics.count("otter.ocr_cache", result="miss")
+        text = self._read_screen_text(image, textline, min_confidence)
+        if self.ocr_cache_size > 0:
+            self.ocr_cache[key] = text
+            while len(self.ocr_cache) > self.ocr_cache_size:
+                self.ocr_cache.popitem(last=False)
+        return text
+
+    # OCR through the daemon, or in-process if it is not reachable. The daemon failing to read the
+    # image raises its RuntimeError, the in-process reader would only hide the error
+    def _readtext(self, image, textline=False, min_confidence=0):
+        if self.ocr_client:
+            try:
+                if isinstance(image, str):
+                    image = np.asarray(Image.open(image).convert("RGB"))
+                return self.ocr_client.readtext(image, textline, min_confidence, self.ocr_backend)
+            except LookupError as e:
+                logging.info(f"{e}, using the in-process {self.ocr_backend} backend")
+                self.ocr_client = None
+            except PermissionError as e:
+                logging.warning(f"{e}, using the in-process reader")
+                self.ocr_client = None
+            except OSError as e:
+                logging.info(f"OCR daemon not available at {self.ocr_client.path}, using the in-process reader")
+                logging.debug(e)
+                self.ocr_client = None
+        return self.ocr.read(image, textline, min_confidence)
+
+    def _read_screen_text(self, image, textline=False, min_confidence=0):
+        with metrics.span("otter.ocr", {"daemon": self.ocr_client is not None, "backend": self.ocr_backend}, textline=textline,
+                          shape=getattr(image, "shape", image)):
+            text = self._readtext(image, textline, min_confidence)
+        if isinstance(image, str):
+            logging.info(f"Read text '{text}' from {image}")
+        else:
+            logging.info(f"Read text '{text}' from memory")
         # TODO: quick hack for easier matching, having separate items might help
         return " ".join(text)
 
-    def wait_screen(self, string, coordinates=(), timeout=360):
-        start = int(time())
-        filename = self.capture_screen_wrapper(coordinates)
-        screen_out = self.get_screen_text(filename)
-        while string not in screen_out:
-            print(screen_out)
-            sleep(1)
-            filename = self.capture_screen_wrapper(coordinates)
-            screen_out = self.get_screen_text(filename)
-            if timeout > 0 and (int(time()) - start) >= timeout:
-                logging.error(f"Wait for {string} timeout out after {timeout} seconds")
-                return False
-        logging.info(f"Waited {int(time())-start} seconds for the string")
+    def _poll_screen(self, coordinates):
+        image = self.capture_screen_array(coordinates)
+        self.poll_count += 1
+        if image is not None and self.screenshot_every > 0 and self.poll_count % self.screenshot_every == 0:
+            self.save_screen(image)
+        return image
+
+    # Number of the last framebuffer update received, to be taken before a capture
+    def _screen_update(self):
+        if self.damage is None:
+            return 0
+        return self.damage.count
+
+    # Block until the VNC server reports an update touching the region after update number since,
+    # or at most timeout seconds. With settle, then keep waiting until the region has had no
+    # updates for settle seconds (debouncing animations), but never past deadline (the end of the
+    # whole wait, 0 for none). Without a VNC update subscription it just sleeps.
+    def _wait_screen_update(self, coordinates, since, timeout, settle=0, deadline=0):
+        if self.damage is None:
+            sleep(timeout)
+            return
+        update = self.damage.wait(coordinates, since, timeout)
+        if update is None:
+            return
+        while settle > 0:
+            quiet = settle
+            if deadline:
+                quiet = min(settle, deadline - time())
+                if quiet <= 0:
+                    return
+            update = self.damage.wait(coordinates, update, quiet)
+            if update is None:
+                return
+
+    # Polls are driven by the VNC framebuffer updates: after a poll the wait sleeps until the server
+    # reports a change in the region, re-polling anyway after interval seconds.
+    def wait_screen(self, string, coordinates=(), timeout=360, textline=False, min_confidence=0, interval=1, settle=0):
+        start = time()
+        last = None
+        polls = 0
+        ocr_runs = 0
+        with metrics.span("otter.wait_screen", string=string, region=coordinates) as span:
+            while True:
+                update = self._screen_update()
+                image = self._poll_screen(coordinates)
+                polls += 1
+                if image is None:
+                    screen_out = ""
+                else:
+                    current = self.fingerprint(image)
+                    # the watched region did not change since the last poll, no need to OCR it again
+                    if current != last:
+                        screen_out = self._cached_screen_text(image, current, textline, min_confidence)
+                        ocr_runs += 1
+                        last = current
+                        if string in screen_out:
+                            break
+                        print(screen_out)
+                if timeout > 0 and (time() - start) >= timeout:
+                    logging.error(f"Wait for {string} timeout out after {timeout} seconds")
+                    span.set(matched=False, polls=polls, ocr_runs=ocr_runs)
+                    metrics.count("otter.wait_timeouts", wait="screen")
+                    # keep the last frame for debugging
+                    if image is not None:
+                        self.save_screen(image)
+                    return False
+                self._wait_screen_update(coordinates, update, interval, settle, start + timeout if timeout > 0 else 0)
+            span.set(matched=True, polls=polls, ocr_runs=ocr_runs, time_to_match=time() - start)
+        logging.info(f"Waited {int(time()-start)} seconds for the string")
         return True
 
+    # Wait until reference (an image path, PIL image or numpy array) appears in the screen region.
+    # If the reference is smaller than the region it is searched anywhere in it.
+    def wait_image(self, reference, coordinates=(), threshold=0.9, timeout=360, interval=1, settle=0):
+        return self.wait_images([reference], coordinates, threshold, timeout, interval, settle) is not None
+
+    # Same as wait_image for several references at once, returns the index of the one that matched
+    # or None on timeout
+    def wait_images(self, references, coordinates=(), threshold=0.9, timeout=360, interval=1, settle=0):
+        start = time()
+        references = [to_grey(reference) for reference in references]
+        last = None
+        polls = 0
+        matches = 0
+        with metrics.span("otter.wait_images", references=len(references), region=coordinates) as span:
+            while True:
+                update = self._screen_update()
+                image = self._poll_screen(coordinates)
+                polls += 1
+                if image is not None:
+                    current = self.fingerprint(image)
+                    # nothing to compare again if the region did not change
+                    if current != last:
+                        last = current
+                        region = to_grey(image)
+                        matches += 1
+                        for index, reference in enumerate(references):
+                            score, position = match_template(region, reference)
+                            logging.debug(f"Reference {index} best score {score:.3f} at {position}")
+                            if score >= threshold:
+                                logging.info(f"Reference {index} matched at {position} with score {score:.3f} after {time()-start:.2f} seconds")
+                                span.set(matched=index, polls=polls, matches=matches, time_to_match=time() - start)
+                                return index
+                if timeout > 0 and (time() - start) >= timeout:
+                    logging.error(f"Wait for {len(references)} reference images timed out after {timeout} seconds")
+                    span.set(matched=None, polls=polls, matches=matches)
+                    metrics.count("otter.wait_timeouts", wait="images")
+                    if image is not None:
+                        self.save_screen(image)
+                    return None
+                self._wait_screen_update(coordinates, update, interval, settle, start + timeout if timeout > 0 else 0)
+
+    # Returns as soon as string appears anywhere in the serial output not consumed yet,
+    # output up to the end of the match is then consumed
     def wait_serial(self, string, timeout=360):
-        start = int(time())
-        serial_out = self.read_serial()
-        while string.encode("utf-8") not in serial_out:
-            logging.debug(serial_out)
-            sleep(1)
-            serial_out = self.read_serial()
-            if timeout > 0 and (int(time()) - start) >= timeout:
-                logging.error(f"Wait for {string} timeout out after {timeout} seconds")
-                return False
-        logging.info(f"Waited {int(time())-start} seconds for the string")
+        start = time()
+        with metrics.span("otter.wait_serial", string=string) as span:
+            end = self.serial_reader.wait_for(string.encode("utf-8"), self.serial_cursor, timeout)
+            span.set(matched=end >= 0)
+        if end < 0:
+            logging.error(f"Wait for {string} timeout out after {timeout} seconds")
+            metrics.count("otter.wait_timeouts", wait="serial")
+            return False
+        self.serial_cursor = end
+        logging.info(f"Waited {int(time()-start)} seconds for the string")
         return True
 
-    def write_serial(self, string):
+    # Wait for any of many patterns at once on the serial output not consumed yet. Patterns can be
+    # literal str/bytes or compiled regular expressions. Returns an ExpectMatch telling which pattern
+    # fired (.index, .pattern) with its text and groups, or None on timeout.
+    # Output up to the end of the match is consumed.
+    def expect_serial(self, patterns, timeout=360):
+        start = time()
+        with metrics.span("otter.expect_serial", patterns=len(patterns)) as span:
+            result = self.serial_reader.expect(Expect(patterns), self.serial_cursor, timeout)
+            span.set(matched=result.index if result else None)
+        if result is None:
+            logging.error(f"Expect of {patterns} timed out after {timeout} seconds")
+            metrics.count("otter.wait_timeouts", wait="expect_serial")
+            return None
+        self.serial_cursor = result.end
+        logging.info(f"Pattern {result.index} matched {result.text!r} after {int(time()-start)} seconds")
+        return result
+
+    # Write string to the serial console one line at a time. With echo, every line is sent as soon as
+    # the guest has echoed the previous one, instead of after a fixed delay: the input goes as fast as
+    # the guest reads it. Without echo (a password prompt, a raw console), lines go out back to back,
+    # paced only by the flow control of the port. If an echo does not come back within echo_timeout
+    # seconds, the rest of the string is written without waiting.
+    def write_serial(self, string, echo=None, echo_timeout=5):
         # TODO: charset decision? let's go for utf-8 for now
-        string = string.encode("utf-8")
+        data = string.encode("utf-8")
+        lines = data.splitlines(keepends=True)
+        echoed = 0
+        if echo is None:
+            echo = self.serial_echo
         try:
-            self.serial_client.write(string)
-            sleep(0.2)
+            with metrics.span("otter.write_serial", bytes=len(data), lines=len(lines)) as span:
+                for line in lines:
+                    start = self.serial_reader.size
+                    self.serial_client.write(line)
+                    # blocks until the port has sent everything, honoring the flow control
+                    self.serial_client.flush()
+                    if echo and line.endswith(b"\n"):
+                        if self.serial_reader.wait_echo(start, line, echo_timeout):
+                            echoed += 1
+                        else:
+                            logging.warning(f"No echo of {line!r} after {echo_timeout} seconds, not waiting for echoes anymore in this session")
+                            echo = False
+                            self.serial_echo = False
+                span.set(echoed=echoed)
+            metrics.count("otter.serial_bytes_written", len(data))
             return True
         except Exception as e:
             logging.error(e)
             return False
 
-    def read_serial(self):
-        full_read = self.serial_client.read(1024)
-        data = full_read
-        while len(data) == 1024:
-            logging.debug(data)
-            data = self.serial_client.read(1024)
-            full_read += data
-        self.serial_output += full_read
-        return full_read
+    # Type text on the VNC console: newlines and tabs become Enter and Tab, uppercase and symbols are
+    # typed with shift when the server needs it. All the key events go out in a single send.
+    def type_text(self, text):
+        return self.type_keys(*[TEXT_KEYS.get(char, char) for char in text])
+
+    # Press and release keys in order, as one send. Keys are characters or vncdotool key names,
+    # chords are joined with "-": type_keys("ctrl-alt-t"), type_keys("a", "b", "enter")
+    def type_keys(self, *keys):
+        try:
+            with metrics.span("otter.type_keys", keys=len(keys)):
+                call_protocol(self.vnc_client, "typeKeys", keys)
+            return True
+        except Exception as e:
+            logging.error(f"Failed to send {len(keys)} keys: {e}")
+            return False
+
+    # Returns the serial output received since the last read or wait, after
+    # letting it accumulate for timeout seconds
+    def read_serial(self, timeout=1):
+        if timeout > 0:
+            sleep(timeout)
+        data = self.serial_reader.read(self.serial_cursor)
+        self.serial_cursor += len(data)
+        return data
+
+    # Offset in the serial stream where the next received byte will be
+    @property
+    def serial_offset(self):
+        if not self.serial_reader:
+            return 0
+        return self.serial_reader.size
+
+    # Serial output between two stream offsets, read back from serial.log if no longer in memory
+    def serial_log(self, start=0, end=None):
+        if not self.serial_reader:
+            return b""
+        return self.serial_reader.read(start, end)
+
+    # Offset of the first occurrence of string in the serial log after start, -1 if not found
+    def find_serial(self, string, start=0):
+        if not self.serial_reader:
+            return -1
+        return self.serial_reader.find(string, start)
+
+    # The whole serial communication so far, read back from serial.log: prefer serial_log with an offset
+    @property
+    def serial_output(self):
+        return self.serial_log(0)
 
     def screen(self):
         self.vnc_client.framebufferUpdateRequest(False)
@@ -171,18 +555,27 @@ class Otter:
         # TODO: maybe if something went wrong we can snapshot here like
         #if self.fail:
         #    self.machine.take_snapshot(blabla)
+        exit_started = time()
         # exit the vnc session
+        if self.ocr_client:
+            self.ocr_client.close()
+        # flush the frames still queued and close the video
+        if self.recorder:
+            self.recorder.stop()
+        # only this session is disconnected, the reactor keeps serving the others in the process
         logging.info("Dsconnecting from VNC")
-        self.vnc_client.disconnect()
-        api.shutdown()
-        # kill the websocat processes
-        logging.info("Killing any websocat forwarder")
+        self._detach_vnc()
+        # close the websocket forwarders
+        logging.info("Closing the VNC forwarders")
         self.machine.killVNC()
         # poweroff the machine
         logging.info(f"Powering off the vm {self.machine.name}")
         self.machine.powerOff()
-        # saving the serial log
-        logging.info(f"Saving the serial output to {self.outputfolder}/serial.log")
-        with open(f"{self.outputfolder}/serial.log", "wb") as f:
-            f.write(self.serial_output)
+        # the serial log has been written incrementally, just close it
+        if self.serial_reader:
+            self.serial_reader.stop()
+            logging.info(f"Serial output saved to {self.outputfolder}/serial.log")
+        if metrics.enabled():
+            metrics.record("otter.exit", exit_started, time() - exit_started)
+            metrics.write_trace(f"{self.outputfolder}/trace.json", self.started, self.thread)
 
@@ -0,0 +1,105 @@
+import logging
+import re
+
+# Scoped inline flags that can be carried over from str patterns to the combined bytes regex
+_INLINE_FLAGS = ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"), (re.VERBOSE, "x"))
+# Global inline flags like (?i) at the start of a pattern, they are already in pattern.flags
+# and can not stay inside the group of the combined regex
+_GLOBAL_FLAGS = re.compile(rb"\A(?:\(\?[aiLmsux]+\))+")
+# Numbered backreferences (\1, or (?(1)...) conditionals) that would point to the wrong group
+# once the pattern is a part of the combined regex
+_NUMBERED_REFERENCE = re.compile(rb"(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(\d")
+
+def _to_bytes_regex(pattern):
+    if isinstance(pattern, str):
+        return re.escape(pattern.encode("utf-8"))
+    if isinstance(pattern, bytes):
+        return re.escape(pattern)
+    source = pattern.pattern
+    if isinstance(source, str):
+        # the serial stream is matched as bytes: a non-ASCII character would become several bytes,
+        # breaking character classes and quantifiers, so only ASCII str regexes are accepted
+        if not source.isascii():
+            raise ValueError(f"Non-ASCII str regex {source!r}, use a bytes regex of the UTF-8 encoding instead")
+        source = source.encode("ascii")
+    source = _GLOBAL_FLAGS.sub(b"", source)
+    flags = "".join(letter for flag, letter in _INLINE_FLAGS if pattern.flags & flag)
+    if flags:
+        return b"(?" + flags.encode("utf-8") + b":" + source + b")"
+    return source
+
+
+def _decode(group):
+    if group is None:
+        return None
+    return group.decode("utf-8", errors="replace")
+
+
+class ExpectMatch:
+    # group is the number of the outer group of the pattern in match, 0 if match is from the pattern alone
+    def __init__(self, index, pattern, compiled, match, group, offset):
+        # which of the patterns fired, and the pattern itself as it was passed
+        self.index = index
+        self.pattern = pattern
+        # absolute offsets in the serial stream
+        self.start = offset + match.start(group)
+        self.end = offset + match.end(group)
+        self.text = _decode(match.group(group))
+        self.groups = tuple(_decode(match.group(group + number)) for number in range(1, compiled.groups + 1))
+        self.groupdict = {name: _decode(match.group(group + number)) for name, number in compiled.groupindex.items()}
+
+    def __repr__(self):
+        return f"ExpectMatch(index={self.index}, text={self.text!r}, groups={self.groups})"
+
+
+# Matches many literal (str or bytes) and regex (compiled re, str or bytes) patterns at once over a stream.
+# All the patterns are compiled in a single alternation so every byte is scanned once, and
+# search() is meant to be called again from the position it returns when more data arrives:
+# only the last `overlap` bytes are scanned again, to catch a match split between two chunks.
+class Expect:
+    def __init__(self, patterns, overlap=1024):
+        if isinstance(patterns, (str, bytes, re.Pattern)):
+            patterns = [patterns]
+        self.patterns = list(patterns)
+        sources = [_to_bytes_regex(pattern) for pattern in self.patterns]
+        self.compiled = [re.compile(source) for source in sources]
+        try:
+            if any(_NUMBERED_REFERENCE.search(source) for source in sources):
+                raise re.error("numbered backreferences")
+            # each pattern is wrapped in its own outer group, lastindex then tells which one fired
+            self.combined = re.compile(b"|".join(b"(" + source + b")" for source in sources))
+            self.group_index = {}
+            group = 1
+            for index, compiled in enumerate(self.compiled):
+                self.group_index[group] = index
+                group += compiled.groups + 1
+        except re.error as e:
+            # usually the same group name used in two patterns, or backreferences that would be
+            # renumbered in the combined regex, scan them one by one instead
+            logging.debug(f"Unable to combine the expect patterns, matching them separately: {e}")
+            self.combined = None
+        self.overlap = max([overlap] + [len(pattern) for pattern in self.patterns if isinstance(pattern, (str, bytes))])
+
+    # Returns (pattern index, match, outer group number) of the earliest match, or None
+    def _first_match(self, buffer, pos):
+        if self.combined:
+            match = self.combined.search(buffer, pos)
+            if not match:
+                return None
+            return self.group_index[match.lastindex], match, match.lastindex
+        best = None
+        for index, compiled in enumerate(self.compiled):
+            match = compiled.search(buffer, pos)
+            if match and (best is None or match.start() < best[1].start()):
+                best = (index, match, 0)
+        return best
+
+    # Search buffer (whose first byte is at absolute stream offset `offset`) from absolute position pos.
+    # Returns (ExpectMatch or None, absolute position for the next search)
+    def search(self, buffer, pos, offset=0):
+        found = self._first_match(buffer, max(pos - offset, 0))
+        if found:
+            index, match, group = found
+            result = ExpectMatch(index, self.patterns[index], self.compiled[index], match, group, offset)
+            return result, result.end
+        return None, max(pos, offset + len(buffer) - self.overlap)
@@ -0,0 +1,52 @@
+import numpy as np
+from PIL import Image
+
+# Grayscale float image from a path, a PIL image or a numpy array (as returned by capture_screen_array)
+def to_grey(image):
+    if isinstance(image, str):
+        image = Image.open(image)
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert("L"), dtype=np.float64)
+    image = np.asarray(image, dtype=np.float64)
+    if image.ndim == 3:
+        return image[..., :3] @ np.array([0.299, 0.587, 0.114])
+    return image
+
+def _window_sums(integral, h, w):
+    return integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w]
+
+# Normalized cross correlation of needle at every position of haystack, both grayscale arrays.
+# The correlation is computed with FFTs and the per window statistics with integral images,
+# so the whole search is a few vectorized numpy operations regardless of the number of positions.
+# Returns (best score between -1 and 1, (x, y) of the best match), or (-1, None) if needle does not fit.
+def match_template(haystack, needle):
+    H, W = haystack.shape
+    h, w = needle.shape
+    if h > H or w > W:
+        return -1.0, None
+    n = h * w
+
+    needle_mean = needle.mean()
+    needle = needle - needle_mean
+    needle_var = np.sum(needle ** 2)
+
+    # circular correlation does not wrap around for the valid positions, so no padding is needed
+    correlation = np.fft.irfft2(np.fft.rfft2(haystack) * np.conj(np.fft.rfft2(needle, s=(H, W))), s=(H, W))
+    correlation = correlation[:H - h + 1, :W - w + 1]
+
+    integral = np.pad(haystack.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    integral_sq = np.pad((haystack ** 2).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    sums = _window_sums(integral, h, w)
+    window_var = np.maximum(_window_sums(integral_sq, h, w) - sums ** 2 / n, 0)
+
+    # a standard deviation below half a grey level is considered flat, where NCC is undefined
+    flat = window_var < 0.25 * n
+    if needle_var < 0.25 * n:
+        # a flat reference only matches an equally flat window of the same brightness
+        scores = np.where(flat & (np.abs(sums / n - needle_mean) < 1), 1.0, 0.0)
+    else:
+        scores = correlation / np.sqrt(np.where(flat, 1, window_var) * needle_var)
+        scores = np.where(flat, 0.0, np.clip(scores, -1, 1))
+
+    index = np.unravel_index(np.argmax(scores), scores.shape)
+    return float(scores[index]), (int(index[1]), int(index[0]))
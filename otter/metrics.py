@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import deque
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, time
+
+# Process-wide timing spans and counters. Disabled by default, and then span() returns a shared
+# object doing nothing and count() returns right away, so instrumented code costs a flag check.
+# Enabled with enable() or OTTER_METRICS=1 in the environment (inherited by runner workers).
+# Spans end up in a Chrome trace (chrome://tracing, Perfetto) with write_trace(); spans and counters
+# are aggregated for Prometheus, as text with prometheus(), in a file or over HTTP.
+_enabled = os.environ.get("OTTER_METRICS", "") not in ("", "0")
+_lock = threading.Lock()
+# (name, start, duration, thread, args) of the finished spans, oldest dropped first
+_events = deque(maxlen=200000)
+# (name, labels) -> value
+_counters = {}
+# (name, labels) -> [count, sum of the durations]
+_durations = {}
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def enabled():
+    return _enabled
+
+def reset():
+    with _lock:
+        _events.clear()
+        _counters.clear()
+        _durations.clear()
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in (labels or {}).items()))
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+# Times a block. args end up in the trace only, labels in the trace and as Prometheus labels (keep
+# them to a few values). set() adds args known only at the end, like the iterations of a wait.
+class Span:
+    __slots__ = ("name", "labels", "args", "start", "clock")
+
+    def __init__(self, name, labels=None, args=None):
+        self.name = name
+        self.labels = labels
+        self.args = args or {}
+
+    def __enter__(self):
+        self.start = time()
+        self.clock = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = perf_counter() - self.clock
+        if exc_type:
+            self.args["error"] = exc_type.__name__
+        record(self.name, self.start, duration, labels=self.labels, **self.args)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+def span(name, labels=None, **args):
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, labels, args)
+
+# Decorator timing every call of a function as a span
+def timed(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Record a span measured elsewhere (for instance a task completed in another thread),
+# thread is the one it is attributed to in the trace
+def record(name, start, duration, thread=None, labels=None, **args):
+    if not _enabled:
+        return
+    labels = dict(labels or {})
+    status = "error" if "error" in args else "ok"
+    key = (name, _labels(dict(labels, status=status)))
+    with _lock:
+        _events.append((name, start, duration, thread or threading.get_ident(), dict(labels, **args)))
+        total = _durations.setdefault(key, [0, 0.0])
+        total[0] += 1
+        total[1] += duration
+
+def count(name, value=1, **labels):
+    if not _enabled:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+# Picklable copy of the aggregates, to be merged in another process with merge()
+def snapshot():
+    with _lock:
+        return {"counters": dict(_counters), "durations": {key: list(value) for key, value in _durations.items()}}
+
+def merge(other):
+    with _lock:
+        for key, value in other["counters"].items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, (number, total) in other["durations"].items():
+            current = _durations.setdefault(key, [0, 0.0])
+            current[0] += number
+            current[1] += total
+
+
+# Write the spans started after since (and with thread, only those of that thread) as a Chrome trace.
+# The process-wide counters are added as metadata.
+def write_trace(path, since=0, thread=None):
+    with _lock:
+        events = [event for event in _events if event[1] >= since and (thread is None or event[3] == thread)]
+        counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in _counters.items()]
+    pid = os.getpid()
+    trace = {
+        "traceEvents": [{"name": name, "cat": name.split(".")[0], "ph": "X", "ts": int(start * 1e6), "dur": int(duration * 1e6),
+                         "pid": pid, "tid": event_thread, "args": args}
+                        for name, start, duration, event_thread, args in events],
+        "displayTimeUnit": "ms",
+        "otherData": {"counters": counters},
+    }
+    try:
+        with open(path, "w") as f:
+            json.dump(trace, f, default=str)
+        logging.info(f"Trace of {len(events)} spans saved to {path}")
+    except OSError as e:
+        logging.error(f"Unable to write the trace to {path}: {e}")
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+# Prometheus text format: counters as <name>_total, spans as <name>_seconds summaries (count and sum)
+def prometheus():
+    with _lock:
+        counters = sorted(_counters.items())
+        durations = sorted(_durations.items())
+    lines = []
+    declared = set()
+    for (name, labels), value in counters:
+        metric = f"{_metric_name(name)}_total"
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric}{_format_labels(labels)} {value}")
+    for (name, labels), (number, total) in durations:
+        metric = f"{_metric_name(name)}_seconds"
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f"# TYPE {metric} summary")
+        lines.append(f"{metric}_count{_format_labels(labels)} {number}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {total:.6f}")
+    return "\n".join(lines) + "\n"
+
+# For the node exporter textfile collector, the file is replaced atomically
+def write_prometheus(path):
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "w") as f:
+            f.write(prometheus())
+        os.replace(temporary, path)
+    except OSError as e:
+        logging.error(f"Unable to write the metrics to {path}: {e}")
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+# Serve the metrics over HTTP from a background thread, on localhost only by default.
+# Returns the server (shutdown() to stop it)
+def serve_prometheus(port=9464, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), _PrometheusHandler)
+    threading.Thread(target=server.serve_forever, name="otter-metrics", daemon=True).start()
+    logging.info(f"Serving metrics on {server.server_address[0]}:{server.server_address[1]}")
+    return server
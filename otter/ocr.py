@@ -0,0 +1,396 @@
+import argparse
+import glob
+import importlib.util
+import json
+import logging
+import os
+import statistics
+import threading
+from shutil import which
+from time import perf_counter
+
+import numpy as np
+from PIL import Image
+
+# One reader per language set, shared by every Otter session in the process
+_readers = {}
+_readers_lock = threading.Lock()
+# sessions running in threads share a reader, one inference at a time on each
+_inference_locks = {}
+# backends by name and options, see get_backend
+_backends = {}
+# thread counts applied to settings shared by the whole process, see _process_threads
+_thread_settings = {}
+# calibrated backends found not installed, warned about once
+_unavailable = set()
+
+# Where calibrate() saves the backend it picked, and "auto" reads it from
+CALIBRATION_FILE = os.environ.get("OTTER_OCR_CALIBRATION", os.path.expanduser("~/.config/otter/ocr.json"))
+
+# easyocr (and torch with it) is imported and its models loaded only the first time
+# screen OCR is actually needed, so serial only sessions never pay for it
+def get_reader(languages=("en",)):
+    key = tuple(languages)
+    with _readers_lock:
+        if key not in _readers:
+            import easyocr
+            logging.info(f"Loading OCR models for {list(key)}")
+            _readers[key] = easyocr.Reader(list(key))
+        return _readers[key]
+
+def _inference_lock(reader):
+    with _readers_lock:
+        return _inference_locks.setdefault(id(reader), threading.Lock())
+
+def filter_results(results, min_confidence=0):
+    return [text for _, text, confidence in results if confidence >= min_confidence]
+
+
+# Image cleanup before recognition. image is a path or a numpy array, the result a numpy array.
+# grayscale drops the colors, upscale_below enlarges regions lower than that many pixels by an
+# integer factor (small UI text is often below what the models were trained on), binarize
+# thresholds with Otsu's method and makes the text dark on light whatever the theme.
+def preprocess(image, grayscale=False, upscale_below=0, binarize=False):
+    if isinstance(image, str):
+        image = np.asarray(Image.open(image).convert("RGB"))
+    if not (grayscale or binarize or (upscale_below and image.shape[0] < upscale_below)):
+        return image
+    picture = Image.fromarray(image)
+    if grayscale or binarize:
+        picture = picture.convert("L")
+    if upscale_below and picture.height < upscale_below:
+        factor = -(-upscale_below // picture.height)
+        picture = picture.resize((picture.width * factor, picture.height * factor), Image.LANCZOS)
+    image = np.asarray(picture)
+    if binarize:
+        image = _binarize(image)
+    return image
+
+def _binarize(grey):
+    histogram = np.bincount(grey.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight = np.cumsum(histogram)
+    total = weight[-1]
+    mean = np.cumsum(histogram * levels)
+    # between class variance for every threshold, Otsu picks the maximum
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (mean[-1] * weight / total - mean) ** 2 / (weight * (total - weight))
+    threshold = int(np.nanargmax(variance))
+    binary = np.where(grey > threshold, 255, 0).astype(np.uint8)
+    # mostly dark means light text on a dark background
+    if np.count_nonzero(binary) < binary.size / 2:
+        binary = 255 - binary
+    return binary
+
+
+# torch and the OpenMP runtime of tesseract take their thread count from settings of the whole
+# process: the last backend created with threads wins for every session of the process
+def _process_threads(setting, threads, apply):
+    with _readers_lock:
+        previous = _thread_settings.get(setting)
+        if previous == threads:
+            return
+        if previous is not None:
+            logging.warning(f"{setting} changed from {previous} to {threads} threads for the whole process")
+        _thread_settings[setting] = threads
+    apply()
+
+
+class _NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+# An OCR engine. read() preprocesses the image, runs _recognize under the inference lock of the
+# engine and filters the (text, confidence) pairs it returns. threads caps the CPU threads used by
+# the engine (0 leaves its default), for easyocr and tesseract it is a setting of the whole process.
+# languages are given as EasyOCR codes.
+class OCRBackend:
+    name = None
+    # preprocessing used unless given, what works best for the engine on screenshots
+    defaults = {}
+
+    def __init__(self, languages=("en",), threads=0, **preprocessing):
+        self.languages = tuple(languages)
+        self.threads = threads
+        self.preprocessing = dict(self.defaults, **preprocessing)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def available(cls):
+        return False
+
+    def _recognize(self, image, textline):
+        raise NotImplementedError
+
+    def read(self, image, textline=False, min_confidence=0):
+        image = preprocess(image, **self.preprocessing)
+        with self.lock:
+            results = self._recognize(image, textline)
+        return [text for text, confidence in results if confidence >= min_confidence]
+
+    def __repr__(self):
+        return f"{type(self).__name__}(threads={self.threads}, {self.preprocessing})"
+
+
+class EasyOCRBackend(OCRBackend):
+    name = "easyocr"
+
+    def __init__(self, languages=("en",), threads=0, **preprocessing):
+        super().__init__(languages, threads, **preprocessing)
+        self.reader = get_reader(self.languages)
+        # the process shares one reader, and torch one thread pool
+        self.lock = _inference_lock(self.reader)
+        if threads:
+            import torch
+            _process_threads("torch", threads, lambda: torch.set_num_threads(threads))
+
+    @classmethod
+    def available(cls):
+        return importlib.util.find_spec("easyocr") is not None
+
+    def _recognize(self, image, textline):
+        if textline:
+            grey = image if image.ndim == 2 else np.asarray(Image.fromarray(image).convert("L"))
+            height, width = grey.shape
+            results = self.reader.recognize(grey, horizontal_list=[[0, width, 0, height]], free_list=[], detail=1)
+        else:
+            results = self.reader.readtext(image, detail=1)
+        return [(text, confidence) for _, text, confidence in results]
+
+
+# Tesseract through pytesseract, no model to keep in memory: every read runs the tesseract binary.
+# Words are grouped back into lines, like the EasyOCR results.
+class TesseractBackend(OCRBackend):
+    name = "tesseract"
+    defaults = {"grayscale": True, "upscale_below": 48}
+    LANGUAGES = {"en": "eng", "de": "deu", "fr": "fra", "it": "ita", "es": "spa"}
+
+    def __init__(self, languages=("en",), threads=0, **preprocessing):
+        super().__init__(languages, threads, **preprocessing)
+        import pytesseract
+        self.pytesseract = pytesseract
+        self.language = "+".join(self.LANGUAGES.get(language, language) for language in self.languages)
+        if threads:
+            # read by the OpenMP runtime of the tesseract processes
+            _process_threads("OMP_THREAD_LIMIT", threads, lambda: os.environ.__setitem__("OMP_THREAD_LIMIT", str(threads)))
+        # the binary runs in its own process, reads of different sessions can overlap
+        self.lock = _NoLock()
+
+    @classmethod
+    def available(cls):
+        return importlib.util.find_spec("pytesseract") is not None and which("tesseract") is not None
+
+    def _recognize(self, image, textline):
+        # page segmentation 7 is a single line, 11 sparse text as found on screens
+        config = "--psm 7" if textline else "--psm 11"
+        data = self.pytesseract.image_to_data(image, lang=self.language, config=config, output_type=self.pytesseract.Output.DICT)
+        lines = {}
+        for index, word in enumerate(data["text"]):
+            confidence = float(data["conf"][index])
+            if not word.strip() or confidence < 0:
+                continue
+            key = (data["block_num"][index], data["par_num"][index], data["line_num"][index])
+            lines.setdefault(key, []).append((word, confidence / 100))
+        return [(" ".join(word for word, _ in words), min(confidence for _, confidence in words))
+                for _, words in sorted(lines.items())]
+
+
+# PP-OCR models on ONNX Runtime through rapidocr_onnxruntime, a fraction of the memory of
+# torch and faster on CPU
+class ONNXBackend(OCRBackend):
+    name = "onnx"
+
+    def __init__(self, languages=("en",), threads=0, **preprocessing):
+        super().__init__(languages, threads, **preprocessing)
+        from rapidocr_onnxruntime import RapidOCR
+        options = {}
+        if threads:
+            options = {"intra_op_num_threads": threads, "inter_op_num_threads": 1}
+        self.engine = RapidOCR(**options)
+
+    @classmethod
+    def available(cls):
+        return importlib.util.find_spec("rapidocr_onnxruntime") is not None
+
+    def _recognize(self, image, textline):
+        if image.ndim == 2:
+            # the models take 3 channels
+            image = np.stack([image] * 3, axis=-1)
+        result, _ = self.engine(image, use_det=not textline, use_cls=False, use_rec=True)
+        if not result:
+            return []
+        if textline:
+            return [(text, float(confidence)) for text, confidence in result]
+        return [(text, float(confidence)) for _, text, confidence in result]
+
+
+BACKENDS = {backend.name: backend for backend in (EasyOCRBackend, TesseractBackend, ONNXBackend)}
+
+def available_backends():
+    return [name for name, backend in BACKENDS.items() if backend.available()]
+
+# The backend saved by calibrate() as (name, options), or (None, {}) without a calibration
+def calibrated_backend(path=CALIBRATION_FILE):
+    try:
+        with open(path) as f:
+            calibration = json.load(f)
+        return calibration["backend"], calibration.get("options", {})
+    except (OSError, ValueError, KeyError):
+        return None, {}
+
+# The concrete (name, options) for name: "auto" is the backend picked by the last calibration, or the
+# first installed one of BACKENDS if there is no calibration or the calibrated one is not installed anymore
+def resolve_backend(name="auto", options=None):
+    options = dict(options or {})
+    if name != "auto":
+        return name, options
+    calibrated_name, calibrated = calibrated_backend()
+    if calibrated_name in BACKENDS and BACKENDS[calibrated_name].available():
+        return calibrated_name, dict(calibrated, **options)
+    # easyocr when nothing is installed, so that loading it fails with the missing module
+    fallback = next(iter(available_backends()), "easyocr")
+    if calibrated_name is not None and calibrated_name not in _unavailable:
+        _unavailable.add(calibrated_name)
+        logging.warning(f"Calibrated OCR backend {calibrated_name} is not available, using {fallback}")
+    return fallback, options
+
+# Backends are created on first use and shared by every session of the process with the same options.
+# name is one of BACKENDS, or "auto" (see resolve_backend).
+def get_backend(name="auto", **options):
+    name, options = resolve_backend(name, options)
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown OCR backend {name}, choose from {', '.join(BACKENDS)}")
+    if "languages" in options:
+        options["languages"] = tuple(options["languages"])
+    key = (name, tuple(sorted(options.items())))
+    with _readers_lock:
+        backend = _backends.get(key)
+    if backend is None:
+        logging.info(f"Loading OCR backend {name} {options}")
+        backend = BACKENDS[name](**options)
+        with _readers_lock:
+            backend = _backends.setdefault(key, backend)
+    return backend
+
+
+# Screenshots to calibrate on: every PNG of folder with its expected text next to it, either in
+# name.txt for the whole image or in name.json as {"text": ..., "region": [x, y, w, h], "textline": false}
+def load_samples(folder):
+    samples = []
+    for path in sorted(glob.glob(os.path.join(folder, "*.png"))):
+        base = os.path.splitext(path)[0]
+        if os.path.exists(f"{base}.json"):
+            with open(f"{base}.json") as f:
+                sample = json.load(f)
+        elif os.path.exists(f"{base}.txt"):
+            with open(f"{base}.txt") as f:
+                sample = {"text": f.read().strip()}
+        else:
+            continue
+        image = np.asarray(Image.open(path).convert("RGB"))
+        if sample.get("region"):
+            x, y, width, height = sample["region"]
+            image = image[y:y + height, x:x + width]
+        samples.append({"path": path, "image": image, "text": sample["text"], "textline": sample.get("textline", False)})
+    return samples
+
+# Share of the expected words found in the text read, case insensitive: Otter waits look for substrings
+def accuracy(expected, text):
+    words = expected.lower().split()
+    if not words:
+        return 1.0
+    text = text.lower()
+    return sum(1 for word in words if word in text) / len(words)
+
+def _rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+PREPROCESSING = {
+    "none": {"grayscale": False, "upscale_below": 0, "binarize": False},
+    "grayscale": {"grayscale": True, "upscale_below": 48, "binarize": False},
+    "binarize": {"grayscale": True, "upscale_below": 48, "binarize": True},
+}
+
+# Measure every backend, thread count and preprocessing on the samples of folder. The fastest
+# variant (median latency per read) reaching the target mean accuracy is saved to output, for
+# get_backend("auto"). Returns the report of all the variants and the one picked (None if none is good enough).
+def calibrate(folder, target=0.9, backends=None, threads=(1,), preprocessing=None, output=CALIBRATION_FILE, repeat=1):
+    samples = load_samples(folder)
+    if not samples:
+        raise ValueError(f"No screenshot with its expected text in {folder}")
+    report = []
+    variants = [(name, thread_count, preset) for name in backends or available_backends()
+                for thread_count in threads for preset in preprocessing or PREPROCESSING]
+    unusable = set()
+    for name, thread_count, preset in variants:
+        if name in unusable:
+            continue
+        options = dict(PREPROCESSING[preset], threads=thread_count)
+        memory_before = _rss()
+        try:
+            backend = get_backend(name, **options)
+            # warm up, the first read of some engines loads more
+            backend.read(samples[0]["image"], samples[0]["textline"])
+        except Exception as e:
+            logging.error(f"OCR backend {name} is not usable: {e}")
+            unusable.add(name)
+            continue
+        latencies = []
+        scores = []
+        for sample in samples:
+            for _ in range(repeat):
+                started = perf_counter()
+                text = " ".join(backend.read(sample["image"], sample["textline"]))
+                latencies.append(perf_counter() - started)
+            scores.append(accuracy(sample["text"], text))
+            logging.debug(f"{name} {preset} read {text!r} on {sample['path']}")
+        variant = {
+            "backend": name,
+            "options": options,
+            "accuracy": statistics.fmean(scores),
+            "median_ms": statistics.median(latencies) * 1000,
+            "p95_ms": sorted(latencies)[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000,
+            # what loading the backend and reading added to the process, shared backends count once
+            "rss_growth_bytes": _rss() - memory_before,
+        }
+        logging.info(f"{name} threads={thread_count} {preset}: accuracy {variant['accuracy']:.2f}, {variant['median_ms']:.0f} ms")
+        report.append(variant)
+    good = [variant for variant in report if variant["accuracy"] >= target]
+    best = min(good, key=lambda variant: variant["median_ms"]) if good else None
+    if best is None:
+        logging.warning(f"No OCR backend reaches an accuracy of {target}, calibration not saved")
+    elif output:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(dict(best, samples=len(samples), target=target), f, indent=2)
+        logging.info(f"Picked OCR backend {best['backend']} {best['options']}, saved to {output}")
+    return report, best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pick the fastest OCR backend reading captured screenshots accurately enough")
+    parser.add_argument("folder", help="PNG screenshots, each with its expected text in a .txt or .json file of the same name")
+    parser.add_argument("--target", type=float, default=0.9, help="minimum share of the expected words read")
+    parser.add_argument("--backends", help=f"comma separated backends to try, all those installed by default ({', '.join(BACKENDS)})")
+    parser.add_argument("--threads", default="1", help="comma separated thread counts to try")
+    parser.add_argument("--preprocessing", help=f"comma separated preprocessing to try, all by default ({', '.join(PREPROCESSING)})")
+    parser.add_argument("--repeat", type=int, default=1, help="reads of every screenshot, for steadier latencies")
+    parser.add_argument("--output", default=CALIBRATION_FILE, help="where to save the backend picked")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    report, best = calibrate(args.folder, args.target,
+                             args.backends.split(",") if args.backends else None,
+                             [int(count) for count in args.threads.split(",")],
+                             args.preprocessing.split(",") if args.preprocessing else None,
+                             args.output, args.repeat)
+    print(json.dumps({"variants": report, "picked": best}, indent=2))
@@ -0,0 +1,228 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+
+import numpy as np
+
+from time import time
+
+# The screenshots sent to the daemon can show passwords: the socket lives in a directory of the user
+# (the XDG runtime dir, or ~/.cache/otter), is only accessible to them, and clients refuse a socket
+# owned by somebody else
+def _default_socket():
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime and os.path.isdir(runtime):
+        return os.path.join(runtime, "otter-ocr.sock")
+    return os.path.join(os.path.expanduser("~/.cache/otter"), "ocr.sock")
+
+DEFAULT_SOCKET = _default_socket()
+
+# Wire format, both ways: 4 bytes big endian header length, a JSON header, then header["size"] raw bytes.
+# A request carries an image as {"shape": [...], "dtype": "uint8", "size": n} followed by its pixels,
+# optionally with "textline", "min_confidence" (see otter.ocr.OCRBackend.read) and "backend", the name of
+# the backend the client expects. A response is {"text": [...]} or {"error": "..."} with no payload, with
+# "backend" set to the name of the backend of the daemon if it is not the one expected.
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("OCR socket closed")
+        data += chunk
+    return bytes(data)
+
+def send_message(sock, header, payload=b""):
+    header = dict(header, size=len(payload))
+    encoded = json.dumps(header).encode("utf-8")
+    sock.sendall(struct.pack(">I", len(encoded)) + encoded + payload)
+
+def recv_message(sock):
+    length = struct.unpack(">I", _recv_exact(sock, 4))[0]
+    header = json.loads(_recv_exact(sock, length).decode("utf-8"))
+    payload = _recv_exact(sock, header["size"]) if header["size"] else b""
+    return header, payload
+
+
+class OCRRequest:
+    def __init__(self, image, textline=False, min_confidence=0):
+        self.image = image
+        self.textline = textline
+        self.min_confidence = min_confidence
+        self.text = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class OCRServer:
+    def __init__(self, path=DEFAULT_SOCKET, batch_size=8, batch_window=0.05, languages=("en",), backend="auto", **options):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.languages = languages
+        self.backend_name = backend
+        # backend options, like threads and preprocessing
+        self.options = options
+        self.backend = None
+        self.requests = queue.Queue()
+
+    # Collect requests from all the clients for up to batch_window seconds and run them together,
+    # with EasyOCR crops of the same size go through a single readtext_batched call
+    def _batch_worker(self):
+        from otter.ocr import EasyOCRBackend, filter_results, preprocess
+        backend = self.backend
+        logging.info(f"OCR backend {backend.name} loaded, ready to serve")
+        while True:
+            batch = [self.requests.get()]
+            deadline = time() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for request in batch:
+                groups.setdefault((request.image.shape, request.textline), []).append(request)
+
+            for (shape, textline), requests in groups.items():
+                try:
+                    # recognition only requests skip detection and are cheap enough one by one
+                    if textline or len(requests) == 1 or not isinstance(backend, EasyOCRBackend):
+                        for request in requests:
+                            request.text = backend.read(request.image, request.textline, request.min_confidence)
+                    else:
+                        images = [preprocess(request.image, **backend.preprocessing) for request in requests]
+                        with backend.lock:
+                            results = backend.reader.readtext_batched(images, detail=1)
+                        for request, result in zip(requests, results):
+                            request.text = filter_results(result, request.min_confidence)
+                except Exception as e:
+                    logging.error(f"OCR of {len(requests)} images of shape {shape} failed")
+                    logging.debug(e)
+                    for request in requests:
+                        request.error = str(e)
+                for request in requests:
+                    request.done.set()
+            logging.debug(f"Served a batch of {len(batch)} images in {len(groups)} groups")
+
+    def serve_forever(self):
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        header, payload = recv_message(self.request)
+                    except (ConnectionError, OSError):
+                        return
+                    expected = header.get("backend", "auto")
+                    if expected not in ("auto", server.backend.name):
+                        send_message(self.request, {"error": f"The daemon runs {server.backend.name}, not {expected}", "backend": server.backend.name})
+                        continue
+                    try:
+                        image = np.frombuffer(payload, dtype=header["dtype"]).reshape(header["shape"])
+                    except Exception as e:
+                        send_message(self.request, {"error": f"Invalid image: {e}"})
+                        continue
+                    request = OCRRequest(image, header.get("textline", False), header.get("min_confidence", 0))
+                    server.requests.put(request)
+                    request.done.wait()
+                    if request.error:
+                        send_message(self.request, {"error": request.error})
+                    else:
+                        send_message(self.request, {"text": request.text})
+
+        from otter.ocr import get_backend
+        # loaded before listening, so that requests can be checked against it
+        self.backend = get_backend(self.backend_name, languages=self.languages, **self.options)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), mode=0o700, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        threading.Thread(target=self._batch_worker, daemon=True).start()
+        # created accessible to the owner only, there is no window where others could connect
+        umask = os.umask(0o077)
+        try:
+            unix_server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        finally:
+            os.umask(umask)
+        with unix_server:
+            unix_server.daemon_threads = True
+            logging.info(f"OCR daemon listening on {self.path}")
+            try:
+                unix_server.serve_forever()
+            finally:
+                os.unlink(self.path)
+
+
+class OCRClient:
+    def __init__(self, path=DEFAULT_SOCKET, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # anybody could have created a socket at a shared path, it would receive every screenshot
+        if os.stat(self.path).st_uid != os.getuid():
+            raise PermissionError(f"OCR socket {self.path} is not owned by the current user, not using it")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+    # Returns the list of strings read on the image, raises OSError if the daemon is not reachable
+    # LookupError if it does not run the backend expected and RuntimeError if it failed to read the image
+    def readtext(self, image, textline=False, min_confidence=0, backend="auto"):
+        image = np.ascontiguousarray(image)
+        header = {"shape": list(image.shape), "dtype": str(image.dtype), "textline": textline, "min_confidence": min_confidence, "backend": backend}
+        with self.lock:
+            if self.sock is None:
+                self._connect()
+            try:
+                send_message(self.sock, header, image.tobytes())
+                header, _ = recv_message(self.sock)
+            except OSError:
+                self.close()
+                raise
+        if "backend" in header:
+            raise LookupError(header["error"])
+        if "error" in header:
+            raise RuntimeError(header["error"])
+        return header["text"]
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared OCR daemon for Otter sessions")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="unix socket path to listen on")
+    parser.add_argument("--batch-size", type=int, default=8, help="maximum number of images per batch")
+    parser.add_argument("--batch-window", type=float, default=0.05, help="seconds to wait for a batch to fill")
+    parser.add_argument("--backend", default="auto", help="OCR backend (easyocr, tesseract, onnx), by default the one picked by the last calibration")
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads of the OCR backend, 0 for its default")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    # without --threads the calibrated thread count is kept
+    options = {"threads": args.threads} if args.threads else {}
+    OCRServer(args.socket, args.batch_size, args.batch_window, backend=args.backend, **options).serve_forever()
@@ -0,0 +1,147 @@
+import logging
+import os
+import queue
+import subprocess
+import threading
+
+from shutil import which
+from time import time
+
+from otter.vnc import call_protocol
+
+# Records the screen of a VNC session to a video file with ffmpeg.
+# The vncdotool client already applies only the damaged rectangles of each incremental update to
+# its framebuffer, the recorder just grabs a frame when the damage tracker reports a change (at most
+# fps per second, nothing at all while the screen is still) and hands it to the encoder thread
+# through a bounded queue. When the encoder falls behind frames are dropped, the test never waits.
+# ffmpeg runs with a single thread and a lower priority, and timestamps frames with the wall clock,
+# so still periods cost nothing. The output is Matroska, readable even if the run is killed.
+# A change of resolution starts a new segment file.
+class ScreenRecorder:
+    def __init__(self, filename, fps=5, queue_size=8, nice=10, crf=30):
+        self.filename = filename
+        self.fps = fps
+        self.nice = nice
+        self.crf = crf
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.client = None
+        self.damage = None
+        self.running = False
+        # set by the encoder when ffmpeg can not be started or dies, the capture stops then
+        self.failed = False
+        self.frames = 0
+        self.dropped = 0
+        self.segment = 0
+        self.ffmpeg = None
+        self.size = None
+        self.capture_thread = None
+        self.encoder_thread = None
+
+    # Record from client (an otter.vnc session), can be called again after a reconnection
+    def attach(self, client):
+        self.client = client
+        self.damage = client.factory.damage if client else None
+
+    def start(self):
+        if not which("ffmpeg"):
+            logging.error("ffmpeg not found in PATH, screen recording disabled")
+            return False
+        self.running = True
+        self.capture_thread = threading.Thread(target=self._capture, name="otter-recorder-capture", daemon=True)
+        self.encoder_thread = threading.Thread(target=self._encode, name="otter-recorder-encoder", daemon=True)
+        self.capture_thread.start()
+        self.encoder_thread.start()
+        return True
+
+    def _capture(self):
+        since = 0
+        last = 0
+        while self.running and not self.failed:
+            damage = self.damage
+            if damage is None:
+                threading.Event().wait(0.5)
+                continue
+            update = damage.wait((), since, 0.5)
+            if update is None:
+                continue
+            since = update
+            # rate limit, the changes in between are in the next frame anyway
+            wait = last + 1 / self.fps - time()
+            if wait > 0:
+                threading.Event().wait(wait)
+            last = time()
+            try:
+                image = call_protocol(self.client, "cropRegion")
+            except Exception as e:
+                logging.debug(f"Recorder capture failed: {e}")
+                continue
+            if image is None:
+                continue
+            image = image.convert("RGB")
+            try:
+                self.queue.put_nowait((image.size, image.tobytes()))
+            except queue.Full:
+                self.dropped += 1
+
+    def _segment_name(self):
+        if self.segment == 0:
+            return self.filename
+        base, extension = os.path.splitext(self.filename)
+        return f"{base}-{self.segment}{extension}"
+
+    def _open(self, size):
+        filename = self._segment_name()
+        command = ["ffmpeg", "-loglevel", "error", "-y",
+                   "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{size[0]}x{size[1]}",
+                   "-use_wallclock_as_timestamps", "1", "-i", "-",
+                   "-c:v", "libx264", "-preset", "ultrafast", "-crf", str(self.crf), "-pix_fmt", "yuv420p",
+                   "-threads", "1", "-fps_mode", "vfr", filename]
+        if self.nice:
+            # not preexec_fn, which is unsafe when the parent has threads
+            command = ["nice", "-n", str(self.nice)] + command
+        logging.info(f"Recording screen to {filename}")
+        self.ffmpeg = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.size = size
+
+    def _close(self):
+        if self.ffmpeg:
+            try:
+                self.ffmpeg.stdin.close()
+            except OSError:
+                pass
+            self.ffmpeg.wait()
+            self.ffmpeg = None
+            self.segment += 1
+
+    def _encode(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            size, data = item
+            try:
+                if size != self.size:
+                    self._close()
+                    self._open(size)
+                self.ffmpeg.stdin.write(data)
+                self.frames += 1
+            except (OSError, ValueError, subprocess.SubprocessError) as e:
+                logging.error(f"Screen recording stopped, ffmpeg failed: {e}")
+                self.failed = True
+                break
+        self._close()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.capture_thread.join(timeout=5)
+        # the encoder finishes the frames already queued, unless it has stopped already
+        # (then nobody empties the queue any more)
+        if self.encoder_thread.is_alive():
+            try:
+                self.queue.put(None, timeout=5)
+                self.encoder_thread.join(timeout=60)
+            except queue.Full:
+                logging.error("Screen recording encoder is stuck, not waiting for it")
+        logging.info(f"Screen recording saved to {self.filename}, {self.frames} frames, {self.dropped} dropped")
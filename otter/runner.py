@@ -0,0 +1,274 @@
+import argparse
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import traceback
+import xml.etree.ElementTree as ET
+from configparser import ConfigParser
+from multiprocessing.pool import ThreadPool
+from time import time
+
+# adapters by config file, shared by the tests running in threads of the same process
+_adapters = {}
+_adapters_lock = threading.Lock()
+
+# Test functions are any module level function named test_* taking the Otter session as argument,
+# written as in example.py with the helpers asserting on failures
+def load_tests(path, keyword=""):
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, [name for name, value in vars(module).items()
+                    if name.startswith("test_") and callable(value) and keyword in name]
+
+def _connect(config):
+    import vmware
+    adapter = vmware.vmwareAdapter(config.get("esx", "username"), config.get("esx", "password"), config.get("esx", "server"), headers={}, verify=False)
+    if not adapter.connection:
+        raise RuntimeError(f"Unable to connect to ESX at {config.get('esx', 'server')}")
+    return adapter
+
+def _shared_adapter(config_path, config):
+    with _adapters_lock:
+        if config_path not in _adapters:
+            _adapters[config_path] = _connect(config)
+        return _adapters[config_path]
+
+# Renews the lease of a machine every interval seconds while a test runs. lost is set when the
+# lease could not be renewed, somebody else may have taken the machine since. Errors talking to
+# the host are retried at the next interval, the lease is still valid for a while then.
+class _LeaseKeeper(threading.Thread):
+    def __init__(self, pool, machine, interval):
+        super().__init__(daemon=True, name="otter-lease")
+        self.pool = pool
+        self.machine = machine
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                renewed = self.pool.renew(self.machine)
+            except Exception as e:
+                logging.error(f"Unable to renew the lease of {self.machine.name}, retrying: {e}")
+                continue
+            if not renewed:
+                self.lost = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join(timeout=60)
+
+
+# Runs in a worker process or thread, with its own leased VM, VNC and serial connections
+def _run_test(path, name, config_path, outputfolder, lease_time, threaded=False, metrics_enabled=False):
+    from otter import Otter, metrics
+    from otter.steps import run_steps
+    from vmware.pool import MachinePool
+
+    root = logging.getLogger()
+    if root.getEffectiveLevel() > logging.INFO:
+        root.setLevel(logging.INFO)
+    handler = logging.FileHandler(os.path.join(outputfolder, "otter.log"))
+    handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    if threaded:
+        # other tests log from other threads of the same process
+        test_thread = threading.get_ident()
+        handler.addFilter(lambda record: record.thread == test_thread)
+    root.addHandler(handler)
+    result = {"name": name, "status": "passed", "message": "", "traceback": "", "outputfolder": outputfolder, "machine": None}
+    start = time()
+    otter = None
+    pool = None
+    vm = None
+    keeper = None
+    try:
+        module, _ = load_tests(path)
+        config = ConfigParser()
+        config.read(config_path)
+        adapter = _shared_adapter(config_path, config)
+        pool = MachinePool(adapter, config.get("esx", "vms"), lease_time=lease_time)
+        test = getattr(module, name)
+        steps = getattr(test, "steps", None)
+        # setup steps revert to their own checkpoints, other tests get a machine ready at kickstart
+        vm = pool.acquire(prepare=None if steps else "kickstart")[0]
+        result["machine"] = vm.name
+        keeper = _LeaseKeeper(pool, vm, lease_time / 3)
+        keeper.start()
+        # setup steps declared with otter.steps.steps() start from their deepest cached checkpoint
+        if steps:
+            otter = run_steps(vm, adapter, steps, testfile=path, outputfolder=outputfolder, metrics_enabled=metrics_enabled)
+        else:
+            otter = Otter(vm, adapter, testfile=path, outputfolder=outputfolder, start_snapshot=None, metrics_enabled=metrics_enabled)
+        test(otter)
+    except AssertionError as e:
+        result["status"] = "failed"
+        result["message"] = str(e) or "assertion failed"
+        result["traceback"] = traceback.format_exc()
+    except Exception as e:
+        result["status"] = "error"
+        result["message"] = f"{type(e).__name__}: {e}"
+        result["traceback"] = traceback.format_exc()
+    finally:
+        if keeper:
+            keeper.stop()
+            if keeper.lost:
+                # the machine may have been reverted under the test, whatever it reported
+                result["status"] = "error"
+                result["message"] = f"Lease of {vm.name} lost during the test"
+                logging.error(result["message"])
+        try:
+            if otter:
+                otter.exit()
+            if pool and vm:
+                pool.release(vm)
+        except Exception as e:
+            logging.error(f"Cleanup of {name} failed: {e}")
+    result["duration"] = time() - start
+    if metrics_enabled and not threaded:
+        # a process per test, its aggregates are merged in the runner
+        result["metrics"] = metrics.snapshot()
+    root.removeHandler(handler)
+    handler.close()
+    return result
+
+
+# Grow the machines matching the vms namespace with linked clones of golden, so that there is
+# a free one for each worker. Returns the adapter and the clones to destroy at the end
+def provision(config_path, golden, workers):
+    from vmware.pool import MachinePool
+    config = ConfigParser()
+    config.read(config_path)
+    adapter = _connect(config)
+    golden_machine = adapter.getMachineByName(golden)
+    if not golden_machine:
+        raise RuntimeError(f"Golden machine {golden} not found")
+    pool = MachinePool(adapter, config.get("esx", "vms"), golden=golden_machine)
+    free = pool.free_count()
+    clones = []
+    if free < workers:
+        clones = adapter.provisionClones(golden_machine, workers - free, prefix=config.get("esx", "vms"))
+    return adapter, clones
+
+
+def write_json(results, filename, duration):
+    summary = {status: sum(1 for result in results if result["status"] == status) for status in ("passed", "failed", "error")}
+    with open(filename, "w") as f:
+        json.dump({"duration": duration, "summary": summary, "tests": results}, f, indent=2)
+
+def write_junit(results, filename, suite, duration):
+    testsuite = ET.Element("testsuite", name=suite, tests=str(len(results)), time=f"{duration:.3f}",
+                           failures=str(sum(1 for result in results if result["status"] == "failed")),
+                           errors=str(sum(1 for result in results if result["status"] == "error")))
+    for result in results:
+        testcase = ET.SubElement(testsuite, "testcase", classname=suite, name=result["name"], time=f"{result['duration']:.3f}")
+        if result["status"] in ("failed", "error"):
+            element = ET.SubElement(testcase, "failure" if result["status"] == "failed" else "error", message=result["message"])
+            element.text = result["traceback"]
+        ET.SubElement(testcase, "system-out").text = f"machine: {result['machine']}\nartifacts: {result['outputfolder']}\nattempt: {result['attempt']}"
+    ET.ElementTree(testsuite).write(filename, encoding="utf-8", xml_declaration=True)
+
+
+# Schedules the tests over a pool of worker processes, one fresh process per test run, or with
+# threaded over threads of this process, sharing the VNC reactor, the ESX connection and the OCR model.
+# Failed tests are retried up to retries times, with fail_fast no new test is started after
+# a failure (running ones are let finish so their machines are cleaned up).
+# With metrics_enabled every session writes trace.json in its folder, and the metrics of all the tests
+# are aggregated in this process (see otter.metrics.prometheus).
+def run(path, workers=2, config_path="otter.ini", outputfolder="results", retries=0, fail_fast=False, keyword="", lease_time=3600, threaded=False, metrics_enabled=False):
+    from otter import metrics
+    if metrics_enabled:
+        metrics.enable()
+    _, tests = load_tests(path, keyword)
+    logging.info(f"Running {len(tests)} tests from {path} on {workers} workers")
+    start = time()
+    pending = [(name, 1) for name in tests]
+    running = 0
+    stop = False
+    results = []
+    done = queue.Queue()
+
+    if threaded:
+        workers_pool = ThreadPool(workers)
+    else:
+        # a process per test keeps a crashing or leaking test from affecting the others
+        workers_pool = multiprocessing.get_context("spawn").Pool(workers, maxtasksperchild=1)
+    with workers_pool as pool:
+        while pending or running:
+            while pending and running < workers and not stop:
+                name, attempt = pending.pop(0)
+                testfolder = os.path.join(outputfolder, name, str(attempt))
+                os.makedirs(testfolder, exist_ok=True)
+                pool.apply_async(_run_test, (path, name, config_path, testfolder, lease_time, threaded, metrics_enabled),
+                                 callback=lambda result, attempt=attempt: done.put((result, attempt)),
+                                 error_callback=lambda e, name=name, attempt=attempt: done.put(({"name": name, "status": "error", "message": str(e), "traceback": "", "outputfolder": None, "machine": None, "duration": 0}, attempt)))
+                running += 1
+            if not running:
+                break
+            result, attempt = done.get()
+            running -= 1
+            result["attempt"] = attempt
+            if "metrics" in result:
+                metrics.merge(result.pop("metrics"))
+            logging.info(f"{result['name']} {result['status']} in {result['duration']:.1f}s (attempt {attempt}) {result['message']}")
+            if result["status"] != "passed" and attempt <= retries:
+                pending.append((result["name"], attempt + 1))
+                continue
+            results.append(result)
+            if result["status"] != "passed" and fail_fast:
+                stop = True
+
+    duration = time() - start
+    skipped = [name for name, _ in pending]
+    if skipped:
+        logging.warning(f"Fail fast, not run: {', '.join(skipped)}")
+    return results, duration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run Otter tests in parallel, one leased VM per worker")
+    parser.add_argument("testfile", help="python file with test_* functions taking an Otter session")
+    parser.add_argument("-w", "--workers", type=int, default=2, help="number of tests run in parallel")
+    parser.add_argument("-c", "--config", default="otter.ini")
+    parser.add_argument("-o", "--output", default="results", help="artifacts folder, one subfolder per test and attempt")
+    parser.add_argument("-k", "--keyword", default="", help="only run tests whose name contains this")
+    parser.add_argument("--retries", type=int, default=0, help="times a failed test is run again")
+    parser.add_argument("--fail-fast", action="store_true", help="do not start new tests after a failure")
+    parser.add_argument("--lease-time", type=int, default=3600, help="seconds a machine is leased for")
+    parser.add_argument("--threads", action="store_true", help="run the tests in threads of a single process, sharing one OCR model")
+    parser.add_argument("--golden", help="add linked clones of this machine until every worker has a free one, destroyed at the end")
+    parser.add_argument("--junit", help="write a JUnit XML report here")
+    parser.add_argument("--json", help="write a JSON report here")
+    parser.add_argument("--metrics", action="store_true", help="record timings, each test writes trace.json in its artifacts folder")
+    parser.add_argument("--prometheus", help="with --metrics, write the aggregated metrics here in Prometheus text format")
+    parser.add_argument("--prometheus-port", type=int, help="with --metrics, serve the aggregated metrics on this port during the run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.metrics and args.prometheus_port:
+        from otter import metrics
+        metrics.serve_prometheus(args.prometheus_port)
+    adapter, clones = provision(args.config, args.golden, args.workers) if args.golden else (None, [])
+    try:
+        results, duration = run(args.testfile, args.workers, args.config, args.output, args.retries, args.fail_fast, args.keyword, args.lease_time, args.threads, args.metrics)
+    finally:
+        if clones:
+            adapter.destroyClones(clones)
+    if args.metrics and args.prometheus:
+        from otter import metrics
+        metrics.write_prometheus(args.prometheus)
+    suite = os.path.splitext(os.path.basename(args.testfile))[0]
+    if args.json:
+        write_json(results, args.json, duration)
+    if args.junit:
+        write_junit(results, args.junit, suite, duration)
+    failed = [result for result in results if result["status"] != "passed"]
+    logging.info(f"{len(results) - len(failed)} passed, {len(failed)} failed in {duration:.1f}s")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,221 @@
+import logging
+import threading
+
+from time import time
+
+from otter.expect import Expect
+
+# Continuously drains a serial port from its own thread.
+# Every chunk is appended to logfile as soon as it arrives, with its arrival time in
+# logfile.timestamps, while only the last tail_size bytes are kept in memory.
+# Positions are absolute offsets in the serial stream, waiters block on a condition
+# variable and are woken up as soon as new data arrives.
+class SerialReader(threading.Thread):
+    def __init__(self, serial_client, logfile=None, tail_size=1024*1024):
+        super().__init__(daemon=True, name="otter-serial-reader")
+        self.serial_client = serial_client
+        self.logfile = logfile
+        self.tail_size = tail_size
+        # in memory tail of the stream, its first byte is at absolute offset self.offset
+        self.buffer = bytearray()
+        self.offset = 0
+        self.condition = threading.Condition()
+        self.running = True
+        # False after a read error, until a new port is attached
+        self.connected = True
+        self.log = None
+        self.timestamps = None
+        if logfile:
+            self.log = open(logfile, "wb")
+            self.timestamps = open(f"{logfile}.timestamps", "w")
+
+    def run(self):
+        while self.running:
+            serial_client = self.serial_client
+            try:
+                # blocks until at least a byte arrives or the port timeout expires
+                data = serial_client.read(1)
+                if data and serial_client.in_waiting:
+                    data += serial_client.read(serial_client.in_waiting)
+            except Exception as e:
+                # the port has been swapped by attach() while reading from the old one
+                if serial_client is not self.serial_client:
+                    continue
+                if self.running:
+                    logging.error("Serial reader failed to read from the serial port, waiting for a new one")
+                    logging.debug(e)
+                with self.condition:
+                    self.connected = False
+                    self.condition.notify_all()
+                    self.condition.wait_for(lambda: serial_client is not self.serial_client or not self.running)
+                continue
+            if data:
+                logging.debug(data)
+                with self.condition:
+                    if self.log:
+                        # one line per chunk: arrival time, stream offset, length
+                        self.timestamps.write(f"{time():.6f} {self.size} {len(data)}\n")
+                        self.log.write(data)
+                        self.log.flush()
+                    self.buffer += data
+                    if len(self.buffer) > self.tail_size:
+                        # deleting from the front of a bytearray does not copy the rest
+                        drop = len(self.buffer) - self.tail_size
+                        del self.buffer[:drop]
+                        self.offset += drop
+                    self.condition.notify_all()
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+
+    # Switch to a new connection to the same console (for instance after a snapshot revert),
+    # the stream goes on from the same offset in the same log
+    def attach(self, serial_client):
+        with self.condition:
+            old = self.serial_client
+            self.serial_client = serial_client
+            self.connected = True
+            self.condition.notify_all()
+        try:
+            old.close()
+        except Exception as e:
+            logging.debug(e)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.join(timeout=5)
+        with self.condition:
+            if self.log:
+                self.log.close()
+                self.timestamps.close()
+                self.log = None
+
+    # Total number of bytes received so far, the offset where new data will start
+    @property
+    def size(self):
+        return self.offset + len(self.buffer)
+
+    # Returns the stream between the absolute offsets start and end, data no longer in memory
+    # is read back from logfile (and is missing if there is none)
+    def read(self, start=0, end=None):
+        with self.condition:
+            if end is None or end > self.size:
+                end = self.size
+            start = max(start, 0)
+            if start >= self.offset or not self.logfile:
+                return bytes(self.buffer[max(start - self.offset, 0):max(end - self.offset, 0)])
+            tail = bytes(self.buffer[:max(end - self.offset, 0)])
+            offset = self.offset
+        # everything before offset is already flushed to disk and never changes
+        with open(self.logfile, "rb") as f:
+            f.seek(start)
+            return f.read(min(end, offset) - start) + tail
+
+    # Returns the absolute offset of the first occurrence of pattern (str or bytes) after start, or -1.
+    # The log on disk is scanned in blocks, so memory stays bounded regardless of the log size.
+    def find(self, pattern, start=0, block_size=1024*1024):
+        if isinstance(pattern, str):
+            pattern = pattern.encode("utf-8")
+        start = max(start, 0)
+        with self.condition:
+            if start >= self.offset or not self.logfile:
+                index = self.buffer.find(pattern, max(start - self.offset, 0))
+                return self.offset + index if index >= 0 else -1
+            size = self.size
+        # the file holds the whole stream up to size, blocks overlap so that no match is split
+        with open(self.logfile, "rb") as f:
+            position = start
+            while position < size:
+                f.seek(position)
+                block = f.read(min(block_size + len(pattern) - 1, size - position))
+                index = block.find(pattern)
+                if index >= 0:
+                    return position + index
+                position += block_size
+        return -1
+
+    # Search the log on disk between the absolute offsets start and end in blocks, for output that
+    # already left the memory tail. Returns (ExpectMatch or None, position for the next search)
+    def _expect_on_disk(self, matcher, start, end, block_size=1024*1024):
+        search_from = start
+        with open(self.logfile, "rb") as f:
+            while search_from < end:
+                position = search_from
+                f.seek(position)
+                block = f.read(min(block_size, end - position))
+                if not block:
+                    break
+                result, search_from = matcher.search(block, position, position)
+                if result:
+                    return result, search_from
+                if position + len(block) >= end:
+                    break
+        return None, search_from
+
+    # Block until any of the patterns of an otter.expect.Expect matches after start, returns the
+    # ExpectMatch or None on timeout (timeout <= 0 waits forever).
+    # Every wakeup only scans the new data, plus the overlap needed for a match split between two reads.
+    # Output after start no longer in memory is searched in the log first, like find() does.
+    def expect(self, matcher, start, timeout=0, block_size=1024*1024):
+        deadline = time() + timeout
+        search_from = start
+        while True:
+            with self.condition:
+                behind = self.offset - search_from if self.logfile else 0
+                if behind <= 0:
+                    result, search_from = matcher.search(self.buffer, search_from, self.offset)
+                elif behind <= block_size:
+                    # a small gap, searched together with the tail so that no match is split
+                    result, search_from = matcher.search(self.read(search_from), search_from, search_from)
+                else:
+                    result = None
+                if behind <= block_size:
+                    if result:
+                        return result
+                    if not self.running or not self.connected:
+                        return None
+                    if timeout > 0:
+                        remaining = deadline - time()
+                        if remaining <= 0:
+                            return None
+                        self.condition.wait(remaining)
+                    else:
+                        self.condition.wait()
+                    continue
+                end = self.offset
+            # a lot of output on disk only, scanned without holding up the reader thread
+            result, search_from = self._expect_on_disk(matcher, search_from, end, block_size)
+            if result:
+                return result
+
+    # Block until the echo of line, written when the stream was at start, has come back: the line
+    # shows up in the output received since start. Whitespace is ignored on both sides, terminals
+    # wrap long lines with extra spaces and carriage returns. A blank line only waits for a newline.
+    # Output no longer in memory is read back from the log. Returns False on timeout or if the port is gone.
+    def wait_echo(self, start, line, timeout=5):
+        deadline = time() + timeout
+        needle = line.translate(None, b" \t\r\n") or b"\n"
+        with self.condition:
+            while True:
+                received = self.read(start)
+                if needle == b"\n":
+                    if needle in received:
+                        return True
+                elif needle in received.translate(None, b" \t\r\n"):
+                    return True
+                if not self.running or not self.connected:
+                    return False
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+
+    # Block until pattern (str or bytes) appears after start, returns the offset right
+    # after the match or -1 on timeout
+    def wait_for(self, pattern, start, timeout=0):
+        result = self.expect(Expect([pattern]), start, timeout)
+        if result is None:
+            return -1
+        return result.end
@@ -0,0 +1,180 @@
+import hashlib
+import inspect
+import logging
+import re
+
+from time import time
+
+from otter import Otter
+
+CHECKPOINT_PREFIX = "otter-ckpt-"
+LAST_USED_PATTERN = re.compile(r"^last-used=(\d+)$", re.M)
+
+# A named setup step, like a helper with its arguments: Step(qubes.login_gui, password="secret").
+# The key identifies what the step does, so that changing the helper code or its arguments
+# makes its checkpoint (and all the following ones) stale.
+class Step:
+    def __init__(self, function, *args, name=None, checkpoint=True, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.name = name or function.__name__
+        # steps whose result can not be reused (random data, external state) are never snapshotted
+        self.checkpoint = checkpoint
+
+    def key(self):
+        try:
+            source = inspect.getsource(self.function)
+        except (OSError, TypeError):
+            source = getattr(self.function, "__qualname__", repr(self.function))
+        return f"{self.name}\n{source}\n{self.args!r}\n{sorted(self.kwargs.items())!r}"
+
+    def __call__(self, otter):
+        return self.function(otter, *self.args, **self.kwargs)
+
+    def __repr__(self):
+        return f"Step({self.name})"
+
+
+# Mark a runner test function with the setup steps to run (or restore) before it
+def steps(*setup):
+    def decorator(function):
+        function.steps = list(setup)
+        return function
+    return decorator
+
+
+# Checkpoints are memory snapshots of a machine, taken after each step and named after the hash
+# of the base snapshot and of the whole step sequence up to there. They form a tree under the
+# base snapshot, tests sharing a prefix share its checkpoints.
+# Before a new checkpoint is taken, the least recently used leaf checkpoints are deleted until
+# the datastores of the machine have at least min_free_space bytes free (and at most
+# max_checkpoints exist, 0 for no limit).
+class CheckpointCache:
+    def __init__(self, machine, base_snapshot="kickstart", min_free_space=50*1024**3, max_checkpoints=0):
+        self.machine = machine
+        self.base_snapshot = base_snapshot
+        self.min_free_space = min_free_space
+        self.max_checkpoints = max_checkpoints
+
+    # Snapshot names of the checkpoints after each step of steps
+    def names(self, steps):
+        base = self.machine.getSnapshot(self.base_snapshot)
+        if not base:
+            return None
+        # a new base snapshot with the same name invalidates everything built on the old one
+        digest = hashlib.sha256(f"{base.name}:{base.id}:{base.timestamp}".encode("utf-8"))
+        names = []
+        for step in steps:
+            digest.update(step.key().encode("utf-8"))
+            names.append(f"{CHECKPOINT_PREFIX}{digest.hexdigest()[:16]}")
+        return names
+
+    # Returns (snapshot to start from, number of steps it already covers)
+    def lookup(self, steps):
+        names = self.names(steps)
+        if names is None:
+            return self.base_snapshot, 0
+        for index in range(len(steps) - 1, -1, -1):
+            if steps[index].checkpoint and self.machine.getSnapshot(names[index]):
+                logging.info(f"Checkpoint {names[index]} covers {index + 1} of {len(steps)} steps")
+                self.touch(names[index])
+                return names[index], index + 1
+        return self.base_snapshot, 0
+
+    def _last_used(self, snapshot):
+        match = LAST_USED_PATTERN.search(snapshot.description or "")
+        return int(match.group(1)) if match else 0
+
+    def _description(self, snapshot_description):
+        last_used = f"last-used={int(time())}"
+        if LAST_USED_PATTERN.search(snapshot_description):
+            return LAST_USED_PATTERN.sub(last_used, snapshot_description)
+        return f"{snapshot_description}\n{last_used}".lstrip("\n")
+
+    # Record the use of a checkpoint in its description, the eviction order
+    def touch(self, name):
+        snapshot = self.machine.getSnapshot(name)
+        try:
+            snapshot.rename(description=self._description(snapshot.description or ""))
+        except Exception as e:
+            logging.debug(f"Unable to update the last use of {name}: {e}")
+
+    # Free bytes on the fullest datastore of the machine, None if it has none listed
+    def _free_space(self):
+        return min((datastore.free_space for datastore in self.machine.listDatastores() or []), default=None)
+
+    # Delete least recently used leaf checkpoints to stay within the budget, keeping the ones in keep.
+    # Returns False if the budget can not be met.
+    def evict(self, keep=()):
+        # checkpoints that could not be deleted, not tried again
+        failed = set()
+        while True:
+            checkpoints = [snapshot for snapshot in self.machine.listSnapshots() or []
+                           if snapshot.name.startswith(CHECKPOINT_PREFIX)]
+            free_space = self._free_space()
+            if free_space is None:
+                # nothing to measure, only the number of checkpoints is enforced
+                logging.debug(f"No datastore listed for {self.machine.name}, free space not checked")
+                free_space = self.min_free_space
+            # the new checkpoint will count as well
+            too_many = self.max_checkpoints > 0 and len(checkpoints) >= self.max_checkpoints
+            if free_space >= self.min_free_space and not too_many:
+                return True
+            # only leaves, deleting an inner checkpoint would not free space its children still need
+            leaves = [snapshot for snapshot in checkpoints if not snapshot.getChild() and snapshot.name not in keep and snapshot.path not in failed]
+            if not leaves:
+                logging.warning(f"Checkpoint budget exceeded ({free_space // 1024**3} GB free) and nothing left to evict")
+                return False
+            victim = min(leaves, key=self._last_used)
+            logging.info(f"Evicting checkpoint {victim.name}, {free_space // 1024**3} GB free")
+            future = self.machine.deleteSnapshot(victim.path, removeChildren=False)
+            if future is None:
+                # already gone (stale index, or deleted by another runner), look again
+                failed.add(victim.path)
+                self.machine.invalidateSnapshots()
+                continue
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Unable to delete checkpoint {victim.name}: {e}")
+                failed.add(victim.path)
+                self.machine.invalidateSnapshots()
+
+    # parent is the snapshot the machine is running from, it is about to get a child and is kept
+    def save(self, otter, name, steps, parent=None):
+        if not self.evict(keep={name, parent}):
+            logging.warning(f"Not taking checkpoint {name}")
+            return False
+        description = "\n".join([
+            f"otter checkpoint after: {', '.join(step.name for step in steps)}",
+            f"testfile={otter.testfile}",
+            f"last-used={int(time())}",
+        ])
+        # the annotation, and the lease of this run in it, is saved with the checkpoint: reverts
+        # put back the lease of whoever restores it (see vmware.Machine.revertSnapshot)
+        otter.take_snapshot(name, description)
+        return True
+
+
+# Start an Otter session on machine with the setup steps done: the session starts from the deepest
+# checkpoint matching a prefix of steps, runs the steps left and checkpoints after each of them.
+# Any other Otter argument can be passed. If a step fails the session is closed and the error raised.
+def run_steps(machine, adapter, steps, testfile="", base_snapshot="kickstart", min_free_space=50*1024**3, max_checkpoints=0, **options):
+    cache = CheckpointCache(machine, base_snapshot, min_free_space, max_checkpoints)
+    start_snapshot, done = cache.lookup(steps)
+    names = cache.names(steps)
+    otter = Otter(machine, adapter, testfile, start_snapshot=start_snapshot, **options)
+    try:
+        for index in range(done, len(steps)):
+            step = steps[index]
+            logging.info(f"Running step {step.name} ({index + 1}/{len(steps)})")
+            started = time()
+            step(otter)
+            logging.info(f"Step {step.name} done in {time() - started:.1f} seconds")
+            if step.checkpoint and names and cache.save(otter, names[index], steps[:index + 1], start_snapshot):
+                start_snapshot = names[index]
+    except BaseException:
+        otter.exit()
+        raise
+    return otter
@@ -0,0 +1,153 @@
+import atexit
+import struct
+import threading
+from collections import deque
+
+from time import sleep, time
+from twisted.internet import reactor
+from twisted.internet.threads import blockingCallFromThread
+from vncdotool import api
+from vncdotool.client import VNCDoToolClient, VNCDoToolFactory
+
+# All the VNC sessions of the process share the Twisted reactor thread started by vncdotool.
+# A Twisted reactor can not be restarted, so it is only stopped when the interpreter exits.
+_reactor_lock = threading.Lock()
+_shutdown_registered = False
+
+# Run a method of the protocol behind an api.connect() client in the reactor thread and return its result.
+# The api proxy itself only works for methods returning the protocol, as it chains every result
+# through the factory deferred.
+def call_protocol(client, method, *args, **kwargs):
+    return blockingCallFromThread(reactor, getattr(client.protocol, method), *args, **kwargs)
+
+def _intersects(rectangle, region):
+    if len(region) != 4:
+        return True
+    x, y, width, height = rectangle
+    rx, ry, rwidth, rheight = region
+    return x < rx + rwidth and rx < x + width and y < ry + rheight and ry < y + height
+
+
+# Keeps the rectangles of the most recent framebuffer updates of a VNC connection, so that waits can be
+# woken up as soon as the server reports changes in the region they are watching.
+# Updates are numbered, a waiter remembers the number it has seen and waits for a newer one.
+class DamageTracker:
+    def __init__(self, history=256):
+        self.condition = threading.Condition()
+        self.count = 0
+        # (update number, rectangles), most recent last
+        self.updates = deque(maxlen=history)
+
+    def add(self, rectangles):
+        with self.condition:
+            self.count += 1
+            self.updates.append((self.count, list(rectangles)))
+            self.condition.notify_all()
+
+    def _changed(self, region, since):
+        # older updates have been dropped from the history, assume they touched the region
+        if self.updates and self.updates[0][0] > since + 1:
+            return True
+        for number, rectangles in reversed(self.updates):
+            if number <= since:
+                break
+            if any(_intersects(rectangle, region) for rectangle in rectangles):
+                return True
+        return False
+
+    # Block until an update newer than since intersects region (x, y, w, h; empty for the whole screen).
+    # Returns the number of the latest update, or None on timeout.
+    def wait(self, region, since, timeout):
+        deadline = time() + timeout
+        with self.condition:
+            while not self._changed(region, since):
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.count
+
+
+# vncdotool client holding a persistent incremental framebuffer subscription: a new incremental
+# update request is sent after every update, so the framebuffer is always current and every damaged
+# rectangle is reported to the factory DamageTracker. Servers may answer several outstanding requests
+# with a single update, so the subscription never waits for all of them to be answered.
+class OtterVNCClient(VNCDoToolClient):
+    def vncConnectionMade(self):
+        super().vncConnectionMade()
+        self.framebufferUpdateRequest(incremental=True)
+
+    def commitUpdate(self, rectangles=None):
+        super().commitUpdate(rectangles)
+        if rectangles:
+            self.factory.damage.add(rectangles)
+        self.framebufferUpdateRequest(incremental=True)
+
+    def updateDesktopSize(self, width, height):
+        super().updateDesktopSize(width, height)
+        self.factory.damage.add([(0, 0, width, height)])
+
+    # Press and release every key of keys (keyPress names, chords like "ctrl-alt-t" included) in order,
+    # the events of all of them in a single write instead of one per event
+    def typeKeys(self, keys):
+        events = []
+        for key in keys:
+            codes = self._decodeKey(key)
+            events += [(1, code) for code in codes] + [(0, code) for code in reversed(codes)]
+        self.transport.write(b"".join(struct.pack("!BBxxI", 4, down, code) for down, code in events))
+        return len(events)
+
+    # Meant to run in the reactor thread with call_protocol, so the framebuffer is never read while being updated
+    def cropRegion(self, x=0, y=0, width=None, height=None):
+        if not self.screen:
+            return None
+        if width is None or height is None:
+            return self.screen.copy()
+        return self.screen.crop((x, y, x + width, y + height))
+
+
+class OtterVNCFactory(VNCDoToolFactory):
+    protocol = OtterVNCClient
+
+    def __init__(self):
+        super().__init__()
+        self.damage = DamageTracker()
+
+
+# The api proxy matches calls and results through a single queue, calls from several threads on
+# the same session are serialized so that nobody gets the result of somebody else
+class OtterVNCProxy(api.ThreadedVNCClientProxy):
+    def __init__(self, factory, timeout=60 * 60):
+        super().__init__(factory, timeout)
+        self.lock = threading.RLock()
+
+    def __getattr__(self, attr):
+        proxied = super().__getattr__(attr)
+        if not callable(proxied):
+            return proxied
+
+        def locked_call(*args, **kwargs):
+            with self.lock:
+                return proxied(*args, **kwargs)
+        return locked_call
+
+    def disconnect(self):
+        with self.lock:
+            super().disconnect()
+
+
+# Connect a new session, starting the shared reactor thread the first time.
+# Sessions are closed with client.disconnect(), which leaves the others running.
+def connect(server, timeout=5):
+    global _shutdown_registered
+    with _reactor_lock:
+        client = api.connect(server=server, factory_class=OtterVNCFactory, proxy=OtterVNCProxy, timeout=timeout)
+        # api.connect only starts the reactor when it is not running yet, wait for it so that
+        # a connect from another thread does not start a second one
+        deadline = time() + timeout
+        while not reactor.running and time() < deadline:
+            sleep(0.01)
+        if not _shutdown_registered:
+            atexit.register(api.shutdown)
+            _shutdown_registered = True
+    return client
@@ -0,0 +1,42 @@
+import re
+
+import pytest
+
+from otter.expect import Expect
+
+
+def test_global_inline_flags():
+    expect = Expect(["Kernel panic", re.compile(r"(?i)login incorrect")])
+    result, _ = expect.search(b"boot\r\nLOGIN INCORRECT\r\n", 0)
+    assert result.index == 1
+    assert result.text == "LOGIN INCORRECT"
+
+
+def test_global_inline_flags_pattern_alone():
+    result, _ = Expect(re.compile(rb"(?s)start.end")).search(b"start\nend", 0)
+    assert result.text == "start\nend"
+
+
+def test_numbered_backreference():
+    expect = Expect(["foo", re.compile(r"(\w)\1x")])
+    result, _ = expect.search(b"zzaax", 0)
+    assert result.index == 1
+    assert result.text == "aax"
+    assert result.groups == ("a",)
+
+
+def test_escaped_backslash_is_not_a_backreference():
+    expect = Expect(["foo", re.compile(rb"\\1")])
+    assert expect.combined is not None
+    result, _ = expect.search(b"a\\1", 0)
+    assert result.index == 1
+
+
+def test_non_ascii_literal():
+    result, _ = Expect("café").search("le café\r\n".encode("utf-8"), 0)
+    assert result.text == "café"
+
+
+def test_non_ascii_str_regex_is_rejected():
+    with pytest.raises(ValueError):
+        Expect(re.compile("caf[é]"))
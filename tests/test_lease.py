@@ -0,0 +1,112 @@
+from time import time
+from types import SimpleNamespace
+
+import pytest
+from pyVmomi import vim
+
+import vmware
+import vmware.pool
+from otter.runner import _LeaseKeeper
+from vmware.pool import MachinePool, parseLease, setLease
+
+
+# A VM whose config holds the annotation, reconfigured with a compare and set on changeVersion.
+# revert() puts back the annotation saved with the snapshot, like vSphere does with the whole config.
+class FakeVM:
+    def __init__(self, moid, snapshot_annotation=""):
+        self._moId = moid
+        self.annotation = ""
+        self.version = 1
+        self.snapshot_annotation = snapshot_annotation
+
+    @property
+    def config(self):
+        return SimpleNamespace(annotation=self.annotation, changeVersion=str(self.version))
+
+    def ReconfigVM_Task(self, spec):
+        if spec.changeVersion != str(self.version):
+            raise vim.fault.ConcurrentAccess()
+        self.annotation = spec.annotation
+        self.version += 1
+
+    def revert(self):
+        self.annotation = self.snapshot_annotation
+        self.version += 1
+        return True
+
+
+def _machine(vm):
+    config = SimpleNamespace(name=vm._moId, template=False, vmPathName="", guestFullName="", instanceUuid="", annotation=vm.annotation)
+    machine = vmware.Machine(vm, properties={"summary.config": config, "summary.runtime.powerState": vim.VirtualMachinePowerState.poweredOff})
+    snapshot = SimpleNamespace(revert=vm.revert, powerstate=vim.VirtualMachinePowerState.poweredOn)
+    machine.getSnapshot = lambda name: snapshot
+    return machine
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(vmware, "waitForTask", lambda task, operation: task)
+    monkeypatch.setattr(vmware.pool, "waitForTask", lambda task, operation: task)
+    vms = {}
+    pool = MachinePool(None, "otter", owner="runner-a")
+    pool._fetchState = lambda machines: {machine.moid: {"config.annotation": vms[machine.moid].annotation,
+                                                        "config.changeVersion": str(vms[machine.moid].version),
+                                                        "runtime.powerState": vim.VirtualMachinePowerState.poweredOff}
+                                         for machine in machines}
+    pool.vms = vms
+    return pool
+
+
+def _lease(pool, vm):
+    pool.vms[vm._moId] = vm
+    machine = _machine(vm)
+    state = pool._fetchState([machine])[machine.moid]
+    assert pool._compareAndSet(machine, state["config.changeVersion"], setLease(vm.annotation, pool.owner, time() + 60))
+    return machine
+
+
+def test_renew_after_revert(pool):
+    vm = FakeVM("vm-1")
+    machine = _lease(pool, vm)
+    assert machine.revertSnapshot("kickstart")
+    assert parseLease(vm.annotation)[0] == "runner-a"
+    assert pool.renew(machine)
+
+
+def test_revert_drops_the_lease_saved_in_the_snapshot(pool):
+    # a checkpoint taken while another runner held the machine
+    vm = FakeVM("vm-2", setLease("", "runner-b", time() + 3600))
+    machine = _lease(pool, vm)
+    machine.revertSnapshot("checkpoint")
+    assert parseLease(vm.annotation)[0] == "runner-a"
+    pool.release(machine)
+    vm.snapshot_annotation = setLease("note", "runner-b", time() + 3600)
+    machine.revertSnapshot("checkpoint")
+    assert vm.annotation == "note\n"
+
+
+def test_keeper_keeps_the_lease_across_reverts(pool):
+    vm = FakeVM("vm-3")
+    machine = _lease(pool, vm)
+    keeper = _LeaseKeeper(pool, machine, 0.01)
+    keeper.start()
+    for _ in range(5):
+        machine.revertSnapshot("kickstart")
+    keeper.stop()
+    assert not keeper.lost
+    assert parseLease(vm.annotation)[0] == "runner-a"
+
+
+def test_acquire_prepares_the_machines(pool):
+    machines = [_machine(FakeVM(f"otter-{index}")) for index in range(2)]
+    for machine in machines:
+        pool.vms[machine.moid] = machine.vmware_object
+    prepared = []
+    pool.adapter = SimpleNamespace(listMachines=lambda: machines,
+                                   prepareMachines=lambda machines, snapshot: prepared.append(snapshot) or machines[:1])
+    # one of them failed to revert, none is kept
+    assert pool.acquire(2, prepare="kickstart") == []
+    assert prepared == ["kickstart"]
+    assert all(parseLease(machine.vmware_object.annotation)[0] is None for machine in machines)
+    pool.adapter.prepareMachines = lambda machines, snapshot: machines
+    assert pool.acquire(2, prepare="kickstart") == machines
@@ -0,0 +1,24 @@
+import json
+
+from otter import ocr
+
+
+def _installed(monkeypatch, *names):
+    for name, backend in ocr.BACKENDS.items():
+        monkeypatch.setattr(backend, "available", classmethod(lambda cls, name=name: name in names))
+
+
+def test_auto_without_calibration_uses_an_installed_backend(monkeypatch, tmp_path):
+    monkeypatch.setattr(ocr.calibrated_backend, "__defaults__", (str(tmp_path / "missing.json"),))
+    _installed(monkeypatch, "onnx")
+    assert ocr.resolve_backend("auto", {"threads": 2}) == ("onnx", {"threads": 2})
+
+
+def test_auto_uses_the_calibration(monkeypatch, tmp_path):
+    path = tmp_path / "ocr.json"
+    path.write_text(json.dumps({"backend": "tesseract", "options": {"threads": 1, "grayscale": True}}))
+    monkeypatch.setattr(ocr.calibrated_backend, "__defaults__", (str(path),))
+    _installed(monkeypatch, "easyocr", "tesseract")
+    assert ocr.resolve_backend("auto", {"threads": 4}) == ("tesseract", {"threads": 4, "grayscale": True})
+    _installed(monkeypatch, "onnx")
+    assert ocr.resolve_backend("auto") == ("onnx", {})
@@ -0,0 +1,69 @@
+import queue
+
+from otter.expect import Expect
+from otter.serialreader import SerialReader
+
+
+# Hands out the chunks put in it, like a serial port with a 0.05 s read timeout
+class FakePort:
+    def __init__(self):
+        self.chunks = queue.Queue()
+        self.in_waiting = 0
+
+    def read(self, size):
+        try:
+            return self.chunks.get(timeout=0.05)
+        except queue.Empty:
+            return b""
+
+    def close(self):
+        pass
+
+
+def _reader(tmp_path, chunks, tail_size=100):
+    port = FakePort()
+    reader = SerialReader(port, str(tmp_path / "serial.log"), tail_size)
+    reader.start()
+    for chunk in chunks:
+        port.chunks.put(chunk)
+    while not port.chunks.empty() or reader.size < sum(len(chunk) for chunk in chunks):
+        with reader.condition:
+            reader.condition.wait(0.05)
+    return reader
+
+
+def test_wait_for_output_already_out_of_the_tail(tmp_path):
+    reader = _reader(tmp_path, [b"x" * 350, b"MARK", b"y" * 300])
+    try:
+        assert reader.offset > 354
+        assert reader.wait_for(b"MARK", 300, 1) == 354
+    finally:
+        reader.stop()
+
+
+def test_expect_split_between_disk_and_tail(tmp_path):
+    reader = _reader(tmp_path, [b"x" * 198, b"MA", b"RK", b"y" * 98])
+    try:
+        # MA is on disk only, RK still in memory
+        assert reader.offset == 200
+        result = reader.expect(Expect(["MARK"]), 0, 1)
+        assert (result.start, result.end) == (198, 202)
+    finally:
+        reader.stop()
+
+
+def test_expect_scans_the_log_in_blocks(tmp_path):
+    reader = _reader(tmp_path, [b"x" * 5000, b"MARK", b"y" * 5000])
+    try:
+        result = reader.expect(Expect(["MARK"]), 10, 1, block_size=1500)
+        assert result.start == 5000
+    finally:
+        reader.stop()
+
+
+def test_wait_echo_out_of_the_tail(tmp_path):
+    reader = _reader(tmp_path, [b"echo hello\r\n", b"z" * 300])
+    try:
+        assert reader.wait_echo(0, b"echo hello\n", 1)
+    finally:
+        reader.stop()
@@ -0,0 +1,42 @@
+import types
+
+from pyVmomi import vim
+
+from vmware import tasks
+from vmware.tasks import TaskEngine, TaskFuture
+
+
+# Fails WaitForUpdatesEx `failures` times, then reports the task done
+class FlakyCollector:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def WaitForUpdatesEx(self, version, options):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError("connection reset")
+        change = types.SimpleNamespace(name="info.state", val=vim.TaskInfo.State.success)
+        object_set = types.SimpleNamespace(obj=types.SimpleNamespace(_moId="task-1"), changeSet=[change])
+        return types.SimpleNamespace(version="1", filterSet=[types.SimpleNamespace(objectSet=[object_set])])
+
+
+def _engine(monkeypatch, failures, retries):
+    monkeypatch.setattr(tasks, "sleep", lambda seconds: None)
+    engine = TaskEngine(None, retries=retries)
+    engine.collector = FlakyCollector(failures)
+    future = TaskFuture(types.SimpleNamespace(_moId="task-1"), "task")
+    future.filter = types.SimpleNamespace(Destroy=lambda: None)
+    engine.futures[future.moid] = future
+    engine._loop()
+    return future
+
+
+def test_transient_errors_are_retried(monkeypatch):
+    future = _engine(monkeypatch, failures=3, retries=5)
+    assert future.exception() is None
+
+
+def test_tasks_fail_after_the_retries(monkeypatch):
+    future = _engine(monkeypatch, failures=10, retries=2)
+    assert isinstance(future.exception(), ConnectionError)
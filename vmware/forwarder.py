@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import ssl
+import threading
+from websockets.asyncio.client import connect
+
+# webmks speaks VNC over a websocket with these subprotocols
+SUBPROTOCOLS = ["binary", "vmware-vvc"]
+
+# A listening TCP socket bridged to a webmks websocket url. The url carries a one time ticket,
+# so only the first client is accepted and the socket stops listening right after.
+class Forward:
+    def __init__(self, forwarder, url, ssl_context):
+        self.forwarder = forwarder
+        self.url = url
+        self.ssl_context = ssl_context
+        self.server = None
+        self.host = None
+        self.port = None
+        # pumps of the session, and the session itself
+        self.pumps = set()
+        self.sessions = set()
+
+    async def _start(self, host, port):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        self.host, self.port = self.server.sockets[0].getsockname()[:2]
+
+    async def _handle(self, reader, writer):
+        self.server.close()
+        session = asyncio.current_task()
+        self.sessions.add(session)
+        websocket = None
+        try:
+            websocket = await connect(self.url, ssl=self.ssl_context, subprotocols=SUBPROTOCOLS,
+                                      compression=None, max_size=None, ping_interval=None, close_timeout=2)
+            pumps = [asyncio.create_task(self._tcpToWebsocket(reader, websocket)),
+                     asyncio.create_task(self._websocketToTcp(websocket, writer))]
+            self.pumps.update(pumps)
+            try:
+                # either side closing ends the session
+                await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for pump in pumps:
+                    pump.cancel()
+                await asyncio.gather(*pumps, return_exceptions=True)
+                self.pumps.difference_update(pumps)
+        except Exception as e:
+            logging.error(f"VNC forward to {self.url.split('/ticket/')[0]} failed: {e}")
+        finally:
+            if websocket:
+                await websocket.close()
+            writer.close()
+            self.sessions.discard(session)
+
+    async def _tcpToWebsocket(self, reader, websocket):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            await websocket.send(data)
+
+    async def _websocketToTcp(self, websocket, writer):
+        async for message in websocket:
+            writer.write(message if isinstance(message, bytes) else message.encode("utf-8"))
+            await writer.drain()
+
+    async def _close(self):
+        self.server.close()
+        # stopping the pumps makes the session close both ends
+        for pump in list(self.pumps):
+            pump.cancel()
+        await asyncio.gather(*self.sessions, return_exceptions=True)
+        await self.server.wait_closed()
+
+    # Stop listening and end the session, returns when everything is closed
+    def close(self, timeout=5):
+        try:
+            self.forwarder.call(self._close(), timeout)
+        except Exception as e:
+            logging.error(f"VNC forwarder on port {self.port} did not close cleanly: {e}")
+
+
+# Runs every Forward of the process in one asyncio event loop, in its own thread
+class VNCForwarder:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="vnc-forwarder", daemon=True)
+        self.thread.start()
+
+    def call(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    # Returns a Forward as soon as it is listening, port 0 binds a free port
+    def forward(self, url, host="127.0.0.1", port=0, verify=True, timeout=10):
+        ssl_context = ssl.create_default_context()
+        if not verify:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        forward = Forward(self, url, ssl_context)
+        self.call(forward._start(host, port), timeout)
+        return forward
+
+
+_forwarder = None
+_forwarder_lock = threading.Lock()
+
+def getForwarder():
+    global _forwarder
+    with _forwarder_lock:
+        if _forwarder is None:
+            _forwarder = VNCForwarder()
+        return _forwarder
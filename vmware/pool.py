@@ -0,0 +1,220 @@
+import logging
+import os
+import re
+import socket
+import threading
+from collections import deque
+from time import time
+from uuid import uuid4
+from pyVmomi import vim, vmodl
+from vmware.tasks import waitForTask
+
+# A lease is a line in the VM annotation, the rest of the annotation is left untouched
+LEASE_PATTERN = re.compile(r"^otter-lease: owner=(?P<owner>\S+) expires=(?P<expires>\d+)\n?", re.M)
+
+def parseLease(annotation):
+    match = LEASE_PATTERN.search(annotation or "")
+    if not match:
+        return None, 0
+    return match.group("owner"), int(match.group("expires"))
+
+def setLease(annotation, owner=None, expires=0):
+    annotation = LEASE_PATTERN.sub("", annotation or "")
+    if owner is None:
+        return annotation
+    if annotation and not annotation.endswith("\n"):
+        annotation += "\n"
+    return f"{annotation}otter-lease: owner={owner} expires={int(expires)}\n"
+
+
+# Hands out machines of the adapter whose name contains `name` to concurrent test sessions, also
+# across processes and hosts sharing the same ESX. A machine is leased by writing the owner and an
+# expiry in its annotation with a compare and set: the reconfigure carries the config changeVersion
+# read before, and fails if anybody else changed the config in the meantime.
+# Expired leases (crashed runners) are considered free. Waiters in the same process are served in
+# FIFO order.
+# With a golden machine, when no machine is free the pool grows with linked clones of it, up to
+# max_size machines matching name (0 for no limit); shrink() destroys them.
+class MachinePool:
+    def __init__(self, adapter, name="", lease_time=3600, owner=None, poll_interval=5, golden=None, max_size=0, snapshot="kickstart"):
+        self.adapter = adapter
+        self.name = name
+        self.lease_time = lease_time
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        self.queue = deque()
+        # machines leased by this pool, by moid
+        self.leased = {}
+        self.golden = golden
+        self.max_size = max_size
+        self.snapshot = snapshot
+        # clones created by grow()
+        self.clones = []
+
+    # Fresh annotation, changeVersion and power state of many machines in a single call
+    def _fetchState(self, machines):
+        if not machines:
+            return {}
+        collector = vmodl.query.PropertyCollector
+        filter_spec = collector.FilterSpec(
+            objectSet=[collector.ObjectSpec(obj=machine.vmware_object) for machine in machines],
+            propSet=[collector.PropertySpec(type=vim.VirtualMachine, pathSet=["config.annotation", "config.changeVersion", "runtime.powerState"])]
+        )
+        content = self.adapter.connection.RetrieveContent()
+        states = {}
+        result = content.propertyCollector.RetrievePropertiesEx([filter_spec], collector.RetrieveOptions())
+        while result:
+            for object_content in result.objects:
+                states[object_content.obj._moId] = {prop.name: prop.val for prop in object_content.propSet}
+            if not result.token:
+                break
+            result = content.propertyCollector.ContinueRetrievePropertiesEx(result.token)
+        return states
+
+    # Returns True if the annotation was written, False if someone else changed the config first
+    def _compareAndSet(self, machine, change_version, annotation):
+        spec = vim.vm.ConfigSpec(annotation=annotation, changeVersion=change_version)
+        try:
+            waitForTask(machine.vmware_object.ReconfigVM_Task(spec=spec), "VirtualMachine.reconfigure")
+        except vim.fault.ConcurrentAccess:
+            return False
+        machine.annotation = annotation
+        return True
+
+    def _isFree(self, state, now):
+        owner, expires = parseLease(state.get("config.annotation"))
+        if owner is not None and expires > now:
+            return False
+        # a stale lease means the VM may still be on from a crashed run, it is reclaimed anyway
+        return owner is not None or state.get("runtime.powerState") == vim.VirtualMachinePowerState.poweredOff
+
+    # Machines matching name, never the golden machine even if its name matches
+    def _members(self):
+        golden = self.golden.moid if self.golden else None
+        return [machine for machine in self.adapter.listMachines()
+                if self.name.lower() in machine.name.lower() and not machine.template and machine.moid != golden]
+
+    # Number of members that could be leased right now
+    def free_count(self):
+        members = self._members()
+        states = self._fetchState(members)
+        now = time()
+        return sum(1 for machine in members if machine.moid in states and self._isFree(states[machine.moid], now))
+
+    # One attempt at leasing count machines, all or nothing
+    def _tryAcquire(self, count):
+        candidates = [machine for machine in self._members() if machine.moid not in self.leased]
+        states = self._fetchState(candidates)
+        now = time()
+        acquired = []
+        for machine in candidates:
+            state = states.get(machine.moid)
+            if not state or not self._isFree(state, now):
+                continue
+            annotation = setLease(state.get("config.annotation"), self.owner, now + self.lease_time)
+            if self._compareAndSet(machine, state["config.changeVersion"], annotation):
+                logging.info(f"Leased {machine.name} until {int(now + self.lease_time)}")
+                acquired.append(machine)
+                self.leased[machine.moid] = machine
+                if len(acquired) == count:
+                    return acquired
+            else:
+                logging.debug(f"Lost the race for {machine.name}")
+        # do not sit on a partial set while waiting for the rest
+        for machine in acquired:
+            self.release(machine)
+        return []
+
+    # Lease count machines, waiting up to timeout seconds for them (0 waits forever). With prepare,
+    # they are then all reverted to that snapshot and powered on at once (see prepareMachines), and
+    # released if any of them fails. Returns the list of Machine objects, or an empty list on timeout.
+    def acquire(self, count=1, timeout=0, prepare=None):
+        machines = self._lease(count, timeout)
+        if not machines or not prepare:
+            return machines
+        ready = self.adapter.prepareMachines(machines, prepare)
+        if len(ready) < len(machines):
+            logging.error(f"Unable to prepare {len(machines) - len(ready)} of the leased machines from snapshot {prepare}")
+            for machine in machines:
+                self.release(machine)
+            return []
+        return machines
+
+    def _lease(self, count, timeout):
+        ticket = object()
+        deadline = time() + timeout
+        with self.condition:
+            self.queue.append(ticket)
+            try:
+                while True:
+                    # only the head of the queue tries, the others wait for their turn
+                    if self.queue[0] is ticket:
+                        machines = self._tryAcquire(count)
+                        if not machines and self.grow(count):
+                            machines = self._tryAcquire(count)
+                        if machines:
+                            return machines
+                    wait = self.poll_interval
+                    if timeout > 0:
+                        remaining = deadline - time()
+                        if remaining <= 0:
+                            logging.error(f"Unable to lease {count} machines matching '{self.name}' in {timeout} seconds")
+                            return []
+                        wait = min(wait, remaining)
+                    self.condition.wait(wait)
+            finally:
+                self.queue.remove(ticket)
+                self.condition.notify_all()
+
+    # Extend the lease of a machine leased by this pool
+    def renew(self, machine):
+        for attempt in range(3):
+            state = self._fetchState([machine]).get(machine.moid, {})
+            owner, _ = parseLease(state.get("config.annotation"))
+            if owner != self.owner:
+                logging.error(f"Lease of {machine.name} has been lost")
+                return False
+            annotation = setLease(state.get("config.annotation"), self.owner, time() + self.lease_time)
+            if self._compareAndSet(machine, state["config.changeVersion"], annotation):
+                return True
+        return False
+
+    def release(self, machine):
+        with self.condition:
+            self.leased.pop(machine.moid, None)
+            for attempt in range(3):
+                state = self._fetchState([machine]).get(machine.moid, {})
+                owner, _ = parseLease(state.get("config.annotation"))
+                if owner != self.owner:
+                    break
+                if self._compareAndSet(machine, state["config.changeVersion"], setLease(state.get("config.annotation"))):
+                    logging.info(f"Released {machine.name}")
+                    break
+            self.condition.notify_all()
+
+    # Add up to count linked clones of the golden machine, within max_size. Returns the number added
+    def grow(self, count):
+        if not self.golden:
+            return 0
+        if self.max_size > 0:
+            count = min(count, self.max_size - len(self._members()))
+        if count <= 0:
+            return 0
+        clones = self.adapter.provisionClones(self.golden, count, self.snapshot, prefix=self.name or None)
+        self.clones += clones
+        return len(clones)
+
+    # Destroy the clones created by grow() that are not leased by anyone
+    def shrink(self):
+        with self.condition:
+            states = self._fetchState(self.clones)
+            now = time()
+            free = [clone for clone in self.clones if clone.moid not in self.leased and
+                    clone.moid in states and parseLease(states[clone.moid].get("config.annotation"))[1] <= now]
+            self.adapter.destroyClones(free)
+            self.clones = [clone for clone in self.clones if clone not in free]
+
+    def releaseAll(self):
+        for machine in list(self.leased.values()):
+            self.release(machine)
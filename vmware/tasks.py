@@ -0,0 +1,188 @@
+import concurrent.futures
+import logging
+import threading
+from time import sleep, time
+from pyVim.task import WaitForTask
+from pyVmomi import vim, vmodl
+
+from otter import metrics
+
+TASK_PROPERTIES = ["info.state", "info.progress", "info.error", "info.result", "info.descriptionId"]
+
+# Future of a vSphere task. The result is the task result (None for most power operations), a failed
+# task raises its fault (for instance vim.fault.InvalidPowerState) from result() and exception(),
+# as WaitForTask would. In asyncio code it can be awaited with asyncio.wrap_future(future).
+class TaskFuture(concurrent.futures.Future):
+    def __init__(self, task, description="", on_success=None):
+        super().__init__()
+        self.task = task
+        self.moid = task._moId
+        self.description = description or self.moid
+        self.state = vim.TaskInfo.State.queued
+        self.progress = 0
+        # localizedMessage of the fault, if the task failed
+        self.error = None
+        self.filter = None
+        # last values of info.error and info.result seen in the updates
+        self.fault = None
+        self.value = None
+        # called with the task result before the future completes, so waiters already see its effects
+        self.on_success = on_success
+        # for the vmware.task span, attributed to the thread that submitted the task
+        self.operation = None
+        self.submitted = time()
+        self.thread = threading.get_ident()
+
+    def __repr__(self):
+        return f"TaskFuture({self.description}, state={self.state}, progress={self.progress})"
+
+
+# Tracks every outstanding task of a connection with a single private PropertyCollector: each task
+# gets a filter on its info, and one thread loops on WaitForUpdatesEx completing the futures as
+# updates arrive. The thread only runs while there are tasks in flight.
+class TaskEngine:
+    def __init__(self, connection, max_wait=5, retries=5):
+        self.connection = connection
+        self.max_wait = max_wait
+        # consecutive WaitForUpdatesEx failures retried, with backoff, before failing every task
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.collector = None
+        self.version = ""
+        self.futures = {}
+        self.thread = None
+
+    def _getCollector(self):
+        if self.collector is None:
+            # a collector of our own, so other users of WaitForUpdates on the session are not disturbed
+            self.collector = self.connection.RetrieveContent().propertyCollector.CreatePropertyCollector()
+        return self.collector
+
+    # Start tracking a task returned by any *_Task method, returns its TaskFuture
+    def submit(self, task, description="", on_success=None):
+        future = TaskFuture(task, description, on_success)
+        collector = vmodl.query.PropertyCollector
+        filter_spec = collector.FilterSpec(
+            objectSet=[collector.ObjectSpec(obj=task)],
+            propSet=[collector.PropertySpec(type=vim.Task, pathSet=TASK_PROPERTIES)]
+        )
+        with self.lock:
+            future.filter = self._getCollector().CreateFilter(filter_spec, partialUpdates=True)
+            self.futures[future.moid] = future
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="vmware-tasks", daemon=True)
+                self.thread.start()
+        logging.debug(f"Submitted task {future.description}")
+        return future
+
+    def _loop(self):
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.max_wait)
+        failures = 0
+        while True:
+            with self.lock:
+                if not self.futures:
+                    self.thread = None
+                    return
+            try:
+                update = self.collector.WaitForUpdatesEx(self.version, options)
+            except Exception as e:
+                if failures < self.retries:
+                    logging.warning(f"Waiting for task updates failed, retrying: {e}")
+                    sleep(0.5 * 2 ** failures)
+                    failures += 1
+                    continue
+                logging.error(f"Waiting for task updates failed: {e}")
+                self._failAll(e)
+                failures = 0
+                continue
+            failures = 0
+            # None means maxWaitSeconds passed without changes
+            if update is None:
+                continue
+            self.version = update.version
+            for filter_set in update.filterSet:
+                for object_set in filter_set.objectSet:
+                    self._update(object_set)
+
+    def _update(self, object_set):
+        with self.lock:
+            future = self.futures.get(object_set.obj._moId)
+        if future is None:
+            return
+        for change in object_set.changeSet:
+            if change.name == "info.state":
+                future.state = change.val
+            elif change.name == "info.progress":
+                future.progress = change.val or 0
+                logging.debug(f"Task {future.description} at {future.progress}%")
+            elif change.name == "info.error":
+                future.fault = change.val
+            elif change.name == "info.result":
+                future.value = change.val
+            elif change.name == "info.descriptionId":
+                future.operation = change.val
+        if future.state == vim.TaskInfo.State.success:
+            future.progress = 100
+            self._finish(future)
+            self._record(future)
+            if future.on_success:
+                try:
+                    future.on_success(future.value)
+                except Exception as e:
+                    logging.error(f"Completion of task {future.description} failed: {e}")
+            future.set_result(future.value)
+        elif future.state == vim.TaskInfo.State.error:
+            fault = future.fault or vmodl.RuntimeFault(msg="Task failed without error details")
+            future.error = getattr(fault, "localizedMessage", None) or getattr(fault, "msg", None) or str(fault)
+            logging.error(f"Task {future.description} failed: {future.error}")
+            self._finish(future)
+            self._record(future, error=type(fault).__name__)
+            future.set_exception(fault)
+
+    def _finish(self, future):
+        with self.lock:
+            self.futures.pop(future.moid, None)
+        try:
+            future.filter.Destroy()
+        except Exception as e:
+            logging.debug(f"Unable to destroy the filter of task {future.description}: {e}")
+
+    def _record(self, future, **args):
+        metrics.record("vmware.task", future.submitted, time() - future.submitted, thread=future.thread,
+                       labels={"operation": future.operation or "unknown"}, description=future.description, **args)
+
+    def _failAll(self, error):
+        with self.lock:
+            futures = list(self.futures.values())
+            # start over with a new collector for the next tasks
+            self.collector = None
+            self.version = ""
+        for future in futures:
+            future.error = str(error)
+            self._finish(future)
+            future.set_exception(error)
+
+
+# WaitForTask, timed as a vmware.task span. operation is what it is aggregated under, like the
+# descriptionId vSphere gives the tasks (VirtualMachine.powerOn)
+def waitForTask(task, operation):
+    with metrics.span("vmware.task", {"operation": operation}):
+        return WaitForTask(task)
+
+
+# Wait for many TaskFutures; returns their results in order. Every task is waited for even if some
+# fail, then the first fault is raised. With raise_errors=False faults are returned in place of results.
+def waitTasks(futures, timeout=None, raise_errors=True):
+    futures = list(futures)
+    done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+    if not_done:
+        raise TimeoutError(f"{len(not_done)} tasks still running after {timeout} seconds")
+    results = []
+    for future in futures:
+        if future.exception() is not None:
+            if raise_errors:
+                raise future.exception()
+            results.append(future.exception())
+        else:
+            results.append(future.result())
+    return results